@@ -0,0 +1,229 @@
+"""
+Estimates the [Summary] block of a diff in a single streaming pass over each file, in a fixed amount of memory.
+
+Meant for continuous drift checks on files that are too large to diff exactly.  File A is streamed first:
+
+    - Every composite key hash goes into a HyperLogLog (unique keys) and a Bloom filter of keys
+    - Every (composite key hash, row fingerprint) goes into a second Bloom filter.  The fingerprint is a hash of the
+      compared (i.e. matched and not unimportant) fields
+
+Then File B is streamed, and each of its rows is classified:
+
+    - Key not in the key filter                      -> present in B but not in A
+    - Key in the key filter, row not in the row filter -> present in both, with diffs
+    - Otherwise                                       -> present in both, no diffs
+
+Rows present in A but not in B are the rows of A that were never matched.  Like the exact diff, this assumes that the
+composite key is unique within each file.
+
+Bloom filters have no false negatives, so the only source of error is false positives, whose rate is known from the
+filter size and fill.  The raw counts are corrected for the expected number of false positives, and the error bound
+printed next to each estimate is three standard deviations of the corrected estimate.  The correction divides by
+(1 - false positive rate), so the bounds widen quickly as the filters fill up: past MAX_FALSE_POSITIVE_RATE a warning
+is logged, and past MAX_USABLE_FALSE_POSITIVE_RATE the estimates are refused.  Field level diff counts need both rows
+side by side, so they are not available in this mode.
+"""
+
+import os
+import csv
+import math
+import hashlib
+import logging
+from helpers import read_headers
+from helpers import match_column_names
+from helpers import resolve_composite_key_fields
+from helpers import make_composite_key
+from sketches import HyperLogLog
+from sketches import BloomFilter
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE_BYTES = 1 << 20  # How much of File A to look at when estimating its row count
+FIELD_SEPARATOR = '\x1f'  # ASCII unit separator.  Keeps ['ab', 'c'] and ['a', 'bc'] from fingerprinting the same
+MAX_FALSE_POSITIVE_RATE = 0.1  # Past this, the error bounds are wide enough that a bigger memory budget is advised
+MAX_USABLE_FALSE_POSITIVE_RATE = 0.99  # Past this, the filters are too full to correct for
+
+
+def _estimate_row_count(file_name: str) -> int:
+    """
+    Estimates the number of rows in a file from the average length of the lines at its start.  Only used to size the
+    Bloom filters, so it doesn't need to be exact
+    """
+    with open(file_name, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE_BYTES)
+    line_count = max(sample.count(b'\n'), 1)
+    ret_val = int(os.path.getsize(file_name) / (len(sample) / line_count)) if sample else 1
+    return ret_val
+
+def _stream_rows(file_name: str, delimiter: str, composite_key_fields: list, compared_fields: list):
+    """
+    Streams a file, yielding the key and row hashes of each row
+    :return: generator of (key_hash, row_hash) tuples.  key_hash is 256 bits, row_hash is 128 bits
+    """
+    with open(file_name, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        header = next(reader)
+        key_indexes = [header.index(field) for field in composite_key_fields]
+        compared_indexes = [header.index(field) for field in compared_fields]
+
+        for row in reader:
+            if not row:
+                continue  # csv.DictReader skips blank rows too
+            key_values = {field: row[i] if i < len(row) else None
+                          for field, i in zip(composite_key_fields, key_indexes)}
+            _, composite_key_hash = make_composite_key(key_values, composite_key_fields)
+
+            fingerprint = hashlib.blake2b(composite_key_hash.encode('ascii'), digest_size=16)
+            fingerprint.update(FIELD_SEPARATOR.join(row[i] if i < len(row) else '\x00'
+                                                    for i in compared_indexes).encode('utf-8'))
+
+            yield int(composite_key_hash, 16), int.from_bytes(fingerprint.digest(), 'big')
+
+def approximate_summary(file_a: str, file_b: str, delimiter: str = None, composite_key_fields: list = None,
+                        unimportant_fields: list = None, memory_mb: float = 64, verbose: bool = False) -> dict:
+    """
+    Estimates the summary counters of a diff without loading either file.  Memory use is fixed by memory_mb
+    :param file_a: The first delimited file to compare
+    :param file_b: The second delimited file to compare
+    :param delimiter: The delimiter to use.  If not passed, will be inferred
+    :param composite_key_fields: A list of fields to use as the composite key.  If not passed, the first matched field
+    :param unimportant_fields: A list of fields to ignore when comparing rows
+    :param memory_mb: The memory budget for the sketches, in megabytes
+    :param verbose: If True, will log verbose output
+    :return: dict of estimated counters, each with an '_error' counterpart giving its error bound
+    """
+
+    delimiter, column_names_a, column_names_b = read_headers(file_a, file_b, delimiter)
+    matched_fields, unmatched_fields = match_column_names(column_names_a, column_names_b)
+    composite_key_fields = resolve_composite_key_fields(composite_key_fields, matched_fields)
+
+    if unimportant_fields is None:
+        unimportant_fields = []
+    elif type(unimportant_fields) is not list:
+        unimportant_fields = [unimportant_fields]
+    for field in unimportant_fields:
+        if field in composite_key_fields:
+            raise ValueError(f"Unimportant field [{field}] is in the composite key fields!  "
+                             f"If it is part of the key, it cannot be specified as unimportant, which causes it to be ignored.")
+    compared_fields = [field for field in matched_fields if field not in unimportant_fields]
+
+    """
+    Size the sketches to the memory budget
+    """
+    budget_bytes = int(memory_mb * (1 << 20))
+    if budget_bytes < 1024:
+        raise ValueError(f"Memory budget [{memory_mb}] MB is too small!  It must be at least 1 KB.")
+    hll_precision = max(4, min(16, int(math.log2(budget_bytes // 16))))
+    unique_keys = HyperLogLog(precision=hll_precision)
+    bloom_bytes = (budget_bytes - unique_keys.size_in_bytes) // 2
+    expected_rows = _estimate_row_count(file_a)
+    keys_in_a = BloomFilter(size_in_bytes=bloom_bytes, expected_items=expected_rows)
+    rows_in_a = BloomFilter(size_in_bytes=bloom_bytes, expected_items=expected_rows)
+
+    if verbose is True:
+        logger.info(f"Sketch sizes: HyperLogLog {unique_keys.size_in_bytes} bytes, Bloom filters 2 x {bloom_bytes} bytes "
+                    f"with {keys_in_a.hash_count} hash functions, sized for ~{expected_rows} rows in File A")
+
+    """
+    Stream File A into the sketches
+    """
+    logger.info(f"Streaming File A [{file_a}]...")
+    lines_in_file_a = 0
+    for key_hash, row_hash in _stream_rows(file_a, delimiter, composite_key_fields, compared_fields):
+        unique_keys.add_hash(key_hash & 0xFFFFFFFFFFFFFFFF)
+        keys_in_a.add_hash(key_hash >> 128)
+        rows_in_a.add_hash(row_hash)
+        lines_in_file_a += 1
+
+    """
+    Stream File B and classify its rows against the sketches of File A
+    """
+    logger.info(f"Streaming File B [{file_b}]...")
+    lines_in_file_b = 0
+    matched_composite_keys = 0
+    present_in_b_not_in_a = 0
+    changed = 0
+    for key_hash, row_hash in _stream_rows(file_b, delimiter, composite_key_fields, compared_fields):
+        unique_keys.add_hash(key_hash & 0xFFFFFFFFFFFFFFFF)
+        lines_in_file_b += 1
+        if not keys_in_a.contains_hash(key_hash >> 128):
+            present_in_b_not_in_a += 1
+        else:
+            matched_composite_keys += 1
+            if not rows_in_a.contains_hash(row_hash):
+                changed += 1
+
+    """
+    Correct for false positives.  A false positive in the key filter turns a B-only row into a matched one, which is
+    then counted as changed unless it also passes the row filter by false positive.  A false positive in the row
+    filter hides a changed row
+    """
+    key_false_positive_rate = keys_in_a.false_positive_rate()
+    row_false_positive_rate = rows_in_a.false_positive_rate()
+    worst_false_positive_rate = max(key_false_positive_rate, row_false_positive_rate)
+    if worst_false_positive_rate > MAX_USABLE_FALSE_POSITIVE_RATE:
+        raise ValueError(f"The Bloom filters are too full to estimate from (false positive rate "
+                         f"{worst_false_positive_rate:.4f})!  Raise the memory budget [{memory_mb}] MB.")
+    if worst_false_positive_rate > MAX_FALSE_POSITIVE_RATE:
+        logger.warning(f"The Bloom filters are filling up (false positive rate {worst_false_positive_rate:.2e}), so the "
+                       f"error bounds are wide.  Raise the memory budget [{memory_mb}] MB for tighter estimates.")
+
+    present_in_b_not_in_a = min(present_in_b_not_in_a / (1 - key_false_positive_rate), lines_in_file_b)
+    changed = ((changed - present_in_b_not_in_a * key_false_positive_rate * (1 - row_false_positive_rate))
+               / (1 - row_false_positive_rate))
+    changed = min(max(changed, 0), lines_in_file_b)
+    matched_composite_keys = lines_in_file_b - present_in_b_not_in_a
+
+    # Three standard deviations of the corrected estimates.  Each observed count is binomial over at most the rows of
+    # File B, and the correction scales its deviation by 1 / (1 - false positive rate).  The changed estimate also
+    # carries the error of the B-only estimate it subtracts
+    key_error = 3 * math.sqrt(lines_in_file_b * key_false_positive_rate) / (1 - key_false_positive_rate)
+    row_error = (3 * math.sqrt(lines_in_file_b * row_false_positive_rate) / (1 - row_false_positive_rate)
+                 + key_false_positive_rate * key_error)
+    present_in_a_not_in_b = max(lines_in_file_a - matched_composite_keys, 0)
+
+    key_error = math.ceil(key_error)
+    row_error = math.ceil(row_error)
+    present_in_b_not_in_a = round(present_in_b_not_in_a)
+    present_in_a_not_in_b = round(present_in_a_not_in_b)
+    matched_composite_keys = round(matched_composite_keys)
+    changed = round(changed)
+
+    ret_val = dict(lines_in_file_a=lines_in_file_a,
+                   lines_in_file_b=lines_in_file_b,
+                   unique_composite_keys=round(unique_keys.estimate()),
+                   unique_composite_keys_error=math.ceil(3 * unique_keys.estimate() * unique_keys.relative_standard_error),
+                   matched_composite_keys=matched_composite_keys,
+                   matched_composite_keys_error=key_error,
+                   total_lines_with_diffs=present_in_a_not_in_b + present_in_b_not_in_a + changed,
+                   total_lines_with_diffs_error=2 * key_error + row_error,  # A-only moves with B-only
+                   present_in_a_not_in_b=present_in_a_not_in_b,
+                   present_in_a_not_in_b_error=key_error,
+                   present_in_b_not_in_a=present_in_b_not_in_a,
+                   present_in_b_not_in_a_error=key_error,
+                   key_false_positive_rate=key_false_positive_rate,
+                   row_false_positive_rate=row_false_positive_rate)
+
+    print("\n\n[Approximate Summary]:")
+    if len(unimportant_fields) > 0:
+        print(f"--> SKIPPED over these unimportant fields: {unimportant_fields}")
+    print(f"Lines in File A: {ret_val['lines_in_file_a']}")
+    print(f"Lines in File B: {ret_val['lines_in_file_b']}")
+    print(f"Unique composite keys across both files: ~{ret_val['unique_composite_keys']} "
+          f"(+/- {ret_val['unique_composite_keys_error']})")
+    print(f"Total lines with diffs (Excluding Unimportant Fields): ~{ret_val['total_lines_with_diffs']} "
+          f"(+/- {ret_val['total_lines_with_diffs_error']})")
+    print("Total field level diffs (Excluding Unimportant Fields): n/a in approximate mode")
+    print(f"Total rows present in A but not in B: ~{ret_val['present_in_a_not_in_b']} "
+          f"(+/- {ret_val['present_in_a_not_in_b_error']})")
+    print(f"Total rows present in B but not in A: ~{ret_val['present_in_b_not_in_a']} "
+          f"(+/- {ret_val['present_in_b_not_in_a_error']})")
+    print(f"Total rows present in both A and B: ~{ret_val['matched_composite_keys']} "
+          f"(+/- {ret_val['matched_composite_keys_error']})")
+    print(f"--> Error bounds are 3 standard deviations.  Bloom filter false positive rates: "
+          f"keys {key_false_positive_rate:.2e}, rows {row_false_positive_rate:.2e}")
+    if worst_false_positive_rate > MAX_FALSE_POSITIVE_RATE:
+        print(f"--> WARNING: False positive rates above {MAX_FALSE_POSITIVE_RATE} make for wide error bounds.  "
+              f"Raise --approx-memory-mb for tighter estimates.")
+
+    return ret_val
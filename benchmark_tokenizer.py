@@ -0,0 +1,75 @@
+"""
+Benchmarks the fast path tokenizer against csv.DictReader, in rows per second, on a TSV file like the ones
+make_test_input_files.py generates
+"""
+
+import io
+import os
+import csv
+import time
+import argparse
+import tempfile
+from helpers import load_file_as_string
+from tokenizer import read_records
+from make_test_input_files import create_line
+
+
+def _time_it(function, repeats: int) -> float:
+    """
+    Runs a function repeats times and returns the best wall clock time, in seconds.  Freeing the result isn't timed
+    """
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        del result
+        best = elapsed if best is None else min(best, elapsed)
+    ret_val = best
+    return ret_val
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the fast path tokenizer against csv.DictReader')
+    parser.add_argument('--rows', '-r',
+                        type=int,
+                        required=False,
+                        default=200000,
+                        help='The number of rows in the generated test file.  Default is 200000.')
+    parser.add_argument('--repeats',
+                        type=int,
+                        required=False,
+                        default=3,
+                        help='How many times each reader is run.  The best time is reported.  Default is 3.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, 'benchmark.tsv')
+        print(f"Generating [{file_name}] with {args.rows} rows...")
+        with open(file_name, 'w') as f:
+            f.write("id\tfoo\tbar\n")
+            for id in range(1, args.rows + 1):
+                f.write(create_line(id) + '\n')
+
+        readers = {
+            'csv.DictReader (previous path)':
+                lambda: list(csv.DictReader(io.StringIO(load_file_as_string(file_name)), delimiter='\t')),
+            'tokenizer csv': lambda: read_records(file_name, '\t', 'csv'),
+            'tokenizer fast': lambda: read_records(file_name, '\t', 'fast'),
+        }
+
+        # All the readers must agree before their timings mean anything
+        expected = readers['csv.DictReader (previous path)']()
+        for name, reader in readers.items():
+            if reader() != expected:
+                raise ValueError(f"Reader [{name}] did not return the same records as csv.DictReader!")
+
+        print(f"\n{'Reader':<32} {'Seconds':>8} {'Rows/sec':>12} {'Speedup':>8}")
+        baseline = None
+        for name, reader in readers.items():
+            seconds = _time_it(reader, args.repeats)
+            baseline = seconds if baseline is None else baseline
+            print(f"{name:<32} {seconds:>8.3f} {args.rows / seconds:>12,.0f} {baseline / seconds:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
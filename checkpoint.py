@@ -0,0 +1,116 @@
+"""
+Checkpoints the bucket results of a long multiprocessing diff, so that a run that dies part way through (out of
+memory, preemption, Ctrl-C) can be resumed instead of started over.
+
+A checkpoint directory holds:
+
+    checkpoint_manifest.json  Fingerprints of both input files and the options that affect the bucket results
+    bucket_XXX.json           The compact result of each finished bucket.  See comparison_result.py
+
+Every file is written to a temp file first and then renamed into place, so a run killed mid-write never leaves a half
+written result behind.  A run pointed at an existing checkpoint directory only diffs the buckets that have no result
+yet, and refuses to resume from a checkpoint that was written for different inputs or options.
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_MANIFEST_FILE_NAME = 'checkpoint_manifest.json'
+FINGERPRINT_CHUNK_SIZE_BYTES = 1 << 20
+
+
+def _bucket_result_file_name(bucket_id: str) -> str:
+    """
+    The file name of the result of one bucket
+    """
+    ret_val = f"bucket_{bucket_id}.json"
+    return ret_val
+
+def _write_json_atomically(path: str, data):
+    """
+    Writes data as JSON to a temp file, then renames it over path
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+def file_fingerprint(file_name: str) -> dict:
+    """
+    Fingerprints the contents of a file.  Hashing is far quicker than diffing, so the whole file is hashed rather
+    than trusting its size and modification time, which change when inputs are copied onto a new node
+    :return: dict with the keys size and blake2b
+    """
+    content_hash = hashlib.blake2b()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(FINGERPRINT_CHUNK_SIZE_BYTES), b''):
+            content_hash.update(chunk)
+
+    ret_val = dict(size=os.path.getsize(file_name), blake2b=content_hash.hexdigest())
+    return ret_val
+
+def make_checkpoint_manifest(file_a: str, file_b: str, options: dict) -> dict:
+    """
+    Builds the manifest that identifies a run
+    :param file_a: The first delimited file being compared
+    :param file_b: The second delimited file being compared
+    :param options: The options that affect the bucket results (composite key fields, unimportant fields, ...).  Must
+        be JSON serializable
+    :return: dict
+    """
+    ret_val = dict(file_a=file_fingerprint(file_a),
+                   file_b=file_fingerprint(file_b),
+                   options=options)
+    return ret_val
+
+def open_checkpoint(checkpoint_dir: str, manifest: dict) -> set:
+    """
+    Starts a new checkpoint, or resumes an existing one
+    :param checkpoint_dir: The checkpoint directory.  It is created if needed
+    :param manifest: The manifest of this run.  See make_checkpoint_manifest()
+    :return: set of the ids of the buckets that are already finished
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest_path = os.path.join(checkpoint_dir, CHECKPOINT_MANIFEST_FILE_NAME)
+
+    if not os.path.isfile(manifest_path):
+        _write_json_atomically(manifest_path, manifest)
+        logger.info(f"Started a new checkpoint in [{checkpoint_dir}]")
+        ret_val = set()
+        return ret_val
+
+    with open(manifest_path, 'r') as f:
+        existing_manifest = json.load(f)
+
+    # Round trip through JSON so that e.g. tuples compare equal to the lists they were saved as
+    manifest = json.loads(json.dumps(manifest))
+    mismatches = [key for key in sorted(set(manifest) | set(existing_manifest))
+                  if manifest.get(key) != existing_manifest.get(key)]
+    if mismatches:
+        raise ValueError(f"The checkpoint in [{checkpoint_dir}] was written for different inputs or options "
+                         f"(mismatched: {mismatches})!  Point --checkpoint-dir at a new directory, or delete this one "
+                         f"to start over.")
+
+    ret_val = set()
+    for file_name in os.listdir(checkpoint_dir):
+        if file_name.startswith('bucket_') and file_name.endswith('.json'):
+            ret_val.add(file_name[len('bucket_'):-len('.json')])
+    logger.info(f"Resuming the checkpoint in [{checkpoint_dir}]: {len(ret_val)} buckets are already finished")
+    return ret_val
+
+def save_bucket_result(checkpoint_dir: str, bucket_id: str, bucket_result: dict):
+    """
+    Persists the result of a finished bucket
+    """
+    _write_json_atomically(os.path.join(checkpoint_dir, _bucket_result_file_name(bucket_id)), bucket_result)
+
+def load_bucket_result(checkpoint_dir: str, bucket_id: str) -> dict:
+    """
+    Loads the result of a bucket finished by an earlier run
+    """
+    with open(os.path.join(checkpoint_dir, _bucket_result_file_name(bucket_id)), 'r') as f:
+        ret_val = json.load(f)
+    return ret_val
@@ -2,8 +2,27 @@
 This module contains the primary comparison algorithm
 """
 import sys
+import heapq
+import logging
 
 from Levenshtein import distance as levenshtein_distance
+from comparison_result import new_counters
+from comparison_result import diff_retention_rank
+
+logger = logging.getLogger(__name__)
+
+def _decode_for_report(value, encoding: str):
+    """
+    Decodes a value read in binary mode, for diff records and Levenshtein distances.  Values are compared as they are,
+    so only the ones that end up in a diff record are ever decoded.  Values that aren't bytes are returned as they are
+    """
+    if isinstance(value, bytes):
+        ret_val = value.decode(encoding, errors='replace')
+    elif isinstance(value, list):
+        ret_val = [_decode_for_report(v, encoding) for v in value]  # Extra fields, collected under the None key
+    else:
+        ret_val = value
+    return ret_val
 
 def _find_record_by_composite_key(list_of_dicts:list, composite_key:str) -> dict:
     """
@@ -24,7 +43,10 @@ def _find_record_by_composite_key(list_of_dicts:list, composite_key:str) -> dict
     return ret_val
 
 def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fields:list = None,
-                     verbose: bool = False, _multiprocessing_bucket_id: str = None) -> dict:
+                     verbose: bool = False, _multiprocessing_bucket_id: str = None,
+                     keep_composite_keys: bool = True, max_diffs: int = None,
+                     max_diffs_order: str = 'hash', keep_unmatched_key_strings: bool = False,
+                     encoding: str = 'utf-8') -> dict:
     """
     The primary comparison algorithm
     :param list_of_dicts_a: The first delimited file, represented as a list of dicts
@@ -33,7 +55,15 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
     :param unimportant_fields: A list of fields that should be ignored when comparing records
     :param _multiprocessing_bucket_id: Just a string to be passed into this function if it's invoked in multiprocessing mode
         it helps with print statements
-    :return: dict
+    :param keep_composite_keys: If True, the full lists of matched, unmatched and all composite keys are returned
+        alongside the diffs and counters.  Otherwise only their counts are returned
+    :param max_diffs: If passed, only this many diff records are kept (the counters are still exact).  A heap of the
+        best ranked records is maintained as we go, so memory does not depend on how badly the lists disagree
+    :param max_diffs_order: How records are ranked when max_diffs is passed.  See comparison_result.MAX_DIFFS_ORDERS
+    :param keep_unmatched_key_strings: If True, the composite key strings of the records found in only one of the lists
+        are returned too.  These are what the near match stage works on
+    :param encoding: Used to decode the values that differ, for records read in binary mode (whose values are bytes)
+    :return: dict.  See comparison_result.py
     """
 
     """
@@ -103,6 +133,10 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
     unmatched_composite_keys_from_list_a = []
     unmatched_composite_keys_from_list_b = []
     diffs = {}  # This is where we'll keep all of the diffs we encounter along the way
+    counters = new_counters()
+    unmatched_key_strings_from_list_a = []
+    unmatched_key_strings_from_list_b = []
+    retained_diffs_heap = []  # (rank, composite key) of the diffs kept so far.  Only used with max_diffs
     counter = 0
     for _composite_key in all_composite_keys:
         counter += 1
@@ -114,9 +148,9 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
         else:
             progress_message = f"Processing composite key {counter} of {len(all_composite_keys)} ({round(counter/len(all_composite_keys)*100, 2)}%))"
         if verbose is True:
-            print(progress_message)
+            logger.info(progress_message)
         elif counter % 500 == 0 or counter >= len(all_composite_keys):
-            print(progress_message)
+            logger.info(progress_message)
 
         composite_key_exists_in_a = False
         composite_key_exists_in_b = False
@@ -180,7 +214,7 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
             for k in all_dict_keys:
                 if k in unimportant_fields:
                     if verbose is True:
-                        print(f"Skipping unimportant field [{k}] for row numbers: A) {record_a['__row_number']} and B) {record_b['__row_number']}")
+                        logger.info(f"Skipping unimportant field [{k}] for row numbers: A) {record_a['__row_number']} and B) {record_b['__row_number']}")
                     continue
 
                 # We don't need to handle the metadata keys inserted by this program
@@ -198,6 +232,8 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
                     record_b_value = record_b.get(k) # Row might be common, but not necessarily fields
 
                     if record_a_value != record_b_value:
+                        record_a_value = _decode_for_report(record_a_value, encoding)
+                        record_b_value = _decode_for_report(record_b_value, encoding)
 
                         # See that the composite key is in the larger diffs object (if this is the first time we've seen it)
                         if _composite_key not in diffs.keys():
@@ -211,6 +247,7 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
                         diffs[_composite_key][k] = {}
                         diffs[_composite_key][k]['__diff_type'] = 'Field Difference'
                         diffs[_composite_key]['__field_differences_count'] += 1
+                        counters['field_level_diffs'] += 1
                         # diffs[_composite_key][f"{k}_A"] = record_a_value #TODO  Drop this in favor of next lines
                         # diffs[_composite_key][f"{k}_B"] = record_b_value #TODO  Drop this in favor of next lines
                         diffs[_composite_key][k]['A'] = record_a_value
@@ -220,26 +257,27 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
                         diffs[_composite_key][k]['__levenshtein_distance'] = _levenshtein_distance
 
                         if verbose is True:
-                            print(f"\nComposite key [{record_a['__composite_key_string']}: {_composite_key}] has a mismatched field [{k}]."
+                            logger.info(f"\nComposite key [{record_a['__composite_key_string']}: {_composite_key}] has a mismatched field [{k}]."
                                   f"\n\tValue in A = [{record_a_value}] (row number {record_a['__row_number']})"
                                   f"\n\tValue in B = [{record_b_value}] (row number {record_b['__row_number']})"
                                   f"\n\tLevenshtein Distance = [{_levenshtein_distance}]")
                     else:
                         if verbose is True:
-                            print(f"\nComposite key [{record_a['__composite_key_string']}: {_composite_key}] has a matched field [{k}]."
+                            logger.info(f"\nComposite key [{record_a['__composite_key_string']}: {_composite_key}] has a matched field [{k}]."
                                   f"\n\tValue in A = [{record_a[k]}] (row number {record_a['__row_number']})"
                                   f"\n\tValue in B = [{record_b[k]}] (row number {record_b['__row_number']})")
 
                 elif row_key_exists_in_a is True and row_key_exists_in_b is False:
                     # The key exists in record_a but not in record_b
                     if verbose is True:
-                        print(f"Composite key [{record_a['__composite_key_string']}: {_composite_key}] has a field [{k}] that exists in A but not in B.  Value in A=[{record_a[k]}]")
+                        logger.info(f"Composite key [{record_a['__composite_key_string']}: {_composite_key}] has a field [{k}] that exists in A but not in B.  Value in A=[{record_a[k]}]")
 
                     if _composite_key not in diffs.keys():
                         diffs[_composite_key] = {}
                         diffs[_composite_key]['__composite_key_hash'] = record_a_composite_key
                         diffs[_composite_key]['__composite_key_string'] = record_a_composite_key_string
 
+                    record_a_value = _decode_for_report(record_a_value, encoding)
                     diffs[_composite_key][f"{k}_Diff_Type"] = 'Row In A but not in B'
                     diffs[_composite_key][f"{k}_A"] = record_a_value
                     diffs[_composite_key][f"{k}_B"] = None
@@ -247,13 +285,14 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
                 elif row_key_exists_in_b is True and row_key_exists_in_a is False:
                     # The key exists in record_b but not in record_a
                     if verbose is True:
-                        print(f"Composite key [{record_b['__composite_key_string']}: {_composite_key}] has a field [{k}] that exists in B but not in A.  Value in B=[{record_b[k]}]")
+                        logger.info(f"Composite key [{record_b['__composite_key_string']}: {_composite_key}] has a field [{k}] that exists in B but not in A.  Value in B=[{record_b[k]}]")
 
                     if _composite_key not in diffs.keys():
                         diffs[_composite_key] = {}
                         diffs[_composite_key]['__composite_key_hash'] = record_b_composite_key
                         diffs[_composite_key]['__composite_key_string'] = record_b_composite_key_string
 
+                    record_b_value = _decode_for_report(record_b_value, encoding)
                     diffs[_composite_key][f"{k}_Diff_Type"] = 'Row In B but not in A'
                     diffs[_composite_key][f"{k}_A"] = None
                     diffs[_composite_key][f"{k}_B"] = record_b_value
@@ -265,43 +304,70 @@ def _make_comparison(list_of_dicts_a:list, list_of_dicts_b:list, unimportant_fie
         elif composite_key_exists_in_a is True and composite_key_exists_in_b is False:
             # The key exists in record_a but not in record_b
             record_a = _find_record_by_composite_key(list_of_dicts=list_of_dicts_a, composite_key=_composite_key)
+            if keep_unmatched_key_strings is True:
+                unmatched_key_strings_from_list_a.append(record_a['__composite_key_string'])
 
             if verbose is True:
-                print(f"Composite key [{record_a['__composite_key_string']}: {_composite_key}] exists in A (row number {record_a['__row_number']}) but not in B.")
+                logger.info(f"Composite key [{record_a['__composite_key_string']}: {_composite_key}] exists in A (row number {record_a['__row_number']}) but not in B.")
 
             if _composite_key not in diffs.keys():
                 diffs[_composite_key] = {}
                 diffs[_composite_key]['_record_present_in_A_not_in_B'] = True
+                counters['present_in_a_not_in_b'] += 1
 
             for k in record_a.keys():
-                diffs[_composite_key][f"{k}_A"] = record_a[k]
+                record_a_value = _decode_for_report(record_a[k], encoding)
+                diffs[_composite_key][f"{k}_A"] = record_a_value
                 diffs[_composite_key][f"{k}_B"] = None
-                diffs[_composite_key][f"{k}_LEVENSHTEIN_DISTANCE"] = len(str(record_a[k]))
+                diffs[_composite_key][f"{k}_LEVENSHTEIN_DISTANCE"] = len(str(record_a_value))
         elif composite_key_exists_in_a is False and composite_key_exists_in_b is True:
             # The key exists in record_b but not in record_a
             record_b = _find_record_by_composite_key(list_of_dicts=list_of_dicts_b, composite_key=_composite_key)
+            if keep_unmatched_key_strings is True:
+                unmatched_key_strings_from_list_b.append(record_b['__composite_key_string'])
 
             if verbose is True:
-                print(f"Composite key [{record_b['__composite_key_string']}: {_composite_key}] exists in B (row number {record_b['__row_number']}) but not in A.")
+                logger.info(f"Composite key [{record_b['__composite_key_string']}: {_composite_key}] exists in B (row number {record_b['__row_number']}) but not in A.")
 
 
             if _composite_key not in diffs.keys():
                 diffs[_composite_key] = {}
                 diffs[_composite_key]['_record_present_in_B_not_in_A'] = True
+                counters['present_in_b_not_in_a'] += 1
 
             for k in record_b.keys():
+                record_b_value = _decode_for_report(record_b[k], encoding)
                 diffs[_composite_key][f"{k}_A"] = None
-                diffs[_composite_key][f"{k}_B"] = record_b[k]
-                diffs[_composite_key][f"{k}_LEVENSHTEIN_DISTANCE"] = len(str(record_b[k]))
+                diffs[_composite_key][f"{k}_B"] = record_b_value
+                diffs[_composite_key][f"{k}_LEVENSHTEIN_DISTANCE"] = len(str(record_b_value))
         else:
             # We should never get here
             raise ValueError(f"Unexpected state!  composite_key_exists_in_a=[{composite_key_exists_in_a}] "
                              f"composite_key_exists_in_b=[{composite_key_exists_in_b}]")
 
-    ret_val = dict(diffs=diffs,
-                   unmatched_composite_keys_from_list_a=unmatched_composite_keys_from_list_a,
-                   unmatched_composite_keys_from_list_b=unmatched_composite_keys_from_list_b,
-                   matched_composite_keys=matched_composite_keys,
-                   all_composite_keys=all_composite_keys)
+        # Count the line with diffs.  If we're only keeping a sample, evict whichever record is now ranked lowest
+        if _composite_key in diffs.keys():
+            counters['total_lines_with_diffs'] += 1
+            if max_diffs is not None:
+                rank = diff_retention_rank(_composite_key, diffs[_composite_key], max_diffs_order)
+                heapq.heappush(retained_diffs_heap, (rank, _composite_key))
+                if len(retained_diffs_heap) > max_diffs:
+                    _, evicted_composite_key = heapq.heappop(retained_diffs_heap)
+                    del diffs[evicted_composite_key]
+
+    counters['lines_in_file_a'] = len(list_of_dicts_a)
+    counters['lines_in_file_b'] = len(list_of_dicts_b)
+    counters['unique_composite_keys'] = len(all_composite_keys)
+    counters['matched_composite_keys'] = len(matched_composite_keys)
+
+    ret_val = dict(diffs=diffs, counters=counters)
+    if keep_composite_keys is True:
+        ret_val['unmatched_composite_keys_from_list_a'] = unmatched_composite_keys_from_list_a
+        ret_val['unmatched_composite_keys_from_list_b'] = unmatched_composite_keys_from_list_b
+        ret_val['matched_composite_keys'] = matched_composite_keys
+        ret_val['all_composite_keys'] = all_composite_keys
+    if keep_unmatched_key_strings is True:
+        ret_val['unmatched_key_strings_from_list_a'] = unmatched_key_strings_from_list_a
+        ret_val['unmatched_key_strings_from_list_b'] = unmatched_key_strings_from_list_b
 
     return ret_val
@@ -0,0 +1,143 @@
+"""
+The result model shared by the comparison algorithm, the multiprocessing workers and the reporting code.
+
+A comparison result is a plain dict (so it pickles cheaply and serializes straight to JSON) with these keys:
+
+    diffs       The diff records, keyed on composite key hash.  Only keys that actually differ are in here
+    counters    Pre-aggregated counters.  See COUNTER_NAMES
+    matched_composite_keys, unmatched_composite_keys_from_list_a, unmatched_composite_keys_from_list_b,
+    all_composite_keys
+                The full key lists.  These are only present when they were asked for, since for mostly matching files
+                they are far larger than everything else in the result
+    unmatched_key_strings_from_list_a, unmatched_key_strings_from_list_b
+                The composite key strings of the records found in only one list.  Only present when asked for, for
+                the near match stage
+
+Workers fill in the counters as they go, so combining the results of many buckets is a matter of adding up
+a handful of integers per bucket rather than walking every diff again.
+
+When only a bounded sample of diffs is wanted (max_diffs), the counters stay exact but the diffs are trimmed to the
+max_diffs highest ranked records.  See MAX_DIFFS_ORDERS
+"""
+
+import heapq
+
+COUNTER_NAMES = ['lines_in_file_a',
+                 'lines_in_file_b',
+                 'unique_composite_keys',
+                 'matched_composite_keys',
+                 'total_lines_with_diffs',
+                 'field_level_diffs',
+                 'present_in_a_not_in_b',
+                 'present_in_b_not_in_a']
+
+COMPOSITE_KEY_LIST_NAMES = ['unmatched_composite_keys_from_list_a',
+                            'unmatched_composite_keys_from_list_b',
+                            'matched_composite_keys',
+                            'all_composite_keys']
+
+UNMATCHED_KEY_STRING_LIST_NAMES = ['unmatched_key_strings_from_list_a',
+                                   'unmatched_key_strings_from_list_b']
+
+# How diff records are ranked when only max_diffs of them are kept:
+#   hash      The records with the lowest composite key hashes.  The hash scatters the keys, so this is an arbitrary
+#             sample, but a stable one: the same files always keep the same records
+#   distance  The records with the largest total Levenshtein distance
+MAX_DIFFS_ORDERS = ['hash', 'distance']
+
+
+def new_counters() -> dict:
+    """
+    Returns a set of counters, all zeroed
+    """
+    ret_val = {counter_name: 0 for counter_name in COUNTER_NAMES}
+    return ret_val
+
+def new_comparison_result(keep_composite_keys: bool = False, keep_unmatched_key_strings: bool = False) -> dict:
+    """
+    Returns an empty comparison result
+    :param keep_composite_keys: If True, the result carries the full key lists
+    :param keep_unmatched_key_strings: If True, the result carries the key strings of the unmatched records
+    :return: dict
+    """
+    ret_val = dict(diffs={}, counters=new_counters())
+    if keep_composite_keys is True:
+        for list_name in COMPOSITE_KEY_LIST_NAMES:
+            ret_val[list_name] = []
+    if keep_unmatched_key_strings is True:
+        for list_name in UNMATCHED_KEY_STRING_LIST_NAMES:
+            ret_val[list_name] = []
+    return ret_val
+
+def merge_counters(counters: dict, other_counters: dict) -> dict:
+    """
+    Adds other_counters into counters, in place.  Counters are additive because buckets (and shards) own disjoint
+    ranges of the key space
+    :return: The merged counters
+    """
+    for counter_name, value in other_counters.items():
+        counters[counter_name] = counters.get(counter_name, 0) + value
+    return counters
+
+def merge_comparison_results(comparison_result: dict, other_comparison_result: dict) -> dict:
+    """
+    Merges other_comparison_result into comparison_result, in place
+    :param comparison_result: The result to merge into.  See new_comparison_result()
+    :param other_comparison_result: The result of a single bucket (or shard)
+    :return: The merged result
+    """
+    comparison_result['diffs'].update(other_comparison_result['diffs'])
+    merge_counters(comparison_result['counters'], other_comparison_result['counters'])
+
+    # The key lists are only carried along if both sides have them
+    for list_name in COMPOSITE_KEY_LIST_NAMES + UNMATCHED_KEY_STRING_LIST_NAMES:
+        if list_name in comparison_result.keys() and list_name in other_comparison_result.keys():
+            comparison_result[list_name].extend(other_comparison_result[list_name])
+
+    return comparison_result
+
+def diff_record_distance(diff_record: dict) -> int:
+    """
+    Sums up the Levenshtein distances recorded in a single diff record
+    :param diff_record: A single entry of the diffs
+    :return: int
+    """
+    ret_val = 0
+    for k, v in diff_record.items():
+        if k.startswith(('__composite_key_', '__row_number_')):
+            continue  # Metadata injected by this program, not data
+        if type(v) is dict:
+            ret_val += v.get('__levenshtein_distance') or 0  # Field Difference
+        elif k.endswith('_LEVENSHTEIN_DISTANCE'):
+            ret_val += v or 0  # Row or field present in one file only
+    return ret_val
+
+def diff_retention_rank(composite_key: str, diff_record: dict, max_diffs_order: str) -> tuple:
+    """
+    Ranks a diff record for max_diffs retention.  Higher ranks are kept
+    :param composite_key: The composite key hash of the record
+    :param diff_record: A single entry of the diffs
+    :param max_diffs_order: One of MAX_DIFFS_ORDERS
+    :return: tuple that sorts in order of preference.  The key hash breaks ties, so ranks are never equal
+    """
+    key_rank = -int(composite_key, 16)  # Lower hashes come first
+    if max_diffs_order == 'hash':
+        ret_val = (key_rank,)
+    elif max_diffs_order == 'distance':
+        ret_val = (diff_record_distance(diff_record), key_rank)
+    else:
+        raise ValueError(f"Unknown max diffs order [{max_diffs_order}]!  Expected one of {MAX_DIFFS_ORDERS}")
+    return ret_val
+
+def trim_diffs(diffs: dict, max_diffs: int, max_diffs_order: str) -> dict:
+    """
+    Keeps only the max_diffs highest ranked diff records
+    :param diffs: The diffs, keyed on composite key hash
+    :param max_diffs: The number of records to keep
+    :param max_diffs_order: One of MAX_DIFFS_ORDERS
+    :return: dict of the retained diffs, best ranked first
+    """
+    retained_keys = heapq.nlargest(max_diffs, diffs.keys(),
+                                   key=lambda k: diff_retention_rank(k, diffs[k], max_diffs_order))
+    ret_val = {k: diffs[k] for k in retained_keys}
+    return ret_val
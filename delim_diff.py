@@ -4,26 +4,41 @@ This program diffs delimited files on a composite key
 
 import os
 import sys
-import csv
-import io
 import argparse
 from itertools import product
-from helpers import load_file_as_string
 from helpers import infer_delimiter
 from helpers import inject_composite_key
+from helpers import match_column_names
+from helpers import resolve_composite_key_fields
 from comparison_algorithm import _make_comparison
-from multiprocessing import Manager, Pool
+from near_match import find_near_matches
+from tokenizer import read_sample
+from tokenizer import read_records
+from tokenizer import TOKENIZERS
+from pipeline import load_into_buckets
+from checkpoint import make_checkpoint_manifest
+from checkpoint import open_checkpoint
+from checkpoint import save_bucket_result
+from checkpoint import load_bucket_result
+from comparison_result import new_comparison_result
+from comparison_result import merge_comparison_results
+from comparison_result import trim_diffs
+from comparison_result import COMPOSITE_KEY_LIST_NAMES
+from comparison_result import MAX_DIFFS_ORDERS
+from multiprocessing import Pool
 import json
+import logging
 
+logger = logging.getLogger(__name__)
 
 
-def process_bucket(bucket: dict, shared_results_dict: dict):
+
+def process_bucket(bucket: dict) -> dict:
     """
     This function is called by the multiprocessing pool.  It is the function that is called in parallel
     Args:
         bucket: The bucket to process
-        shared_results_dict: The shared results dict
-    Returns:
+    Returns: The comparison result for the bucket.  See comparison_result.py
     """
 
     bucket_id = bucket['bucket_id']
@@ -31,31 +46,100 @@ def process_bucket(bucket: dict, shared_results_dict: dict):
     list_b = bucket['B']
     unimportant_fields = bucket['unimportant_fields']
     verbose = bucket['verbose']
+    keep_composite_keys = bucket['keep_composite_keys']
+    max_diffs = bucket['max_diffs']
+    max_diffs_order = bucket['max_diffs_order']
+    keep_unmatched_key_strings = bucket['keep_unmatched_key_strings']
+    encoding = bucket['encoding']
 
     comparison_result = _make_comparison(list_of_dicts_a=list_a, list_of_dicts_b=list_b,
                                          unimportant_fields=unimportant_fields, verbose=verbose,
-                                         _multiprocessing_bucket_id=bucket_id)
-    shared_results_dict[bucket_id] = comparison_result
+                                         _multiprocessing_bucket_id=bucket_id,
+                                         keep_composite_keys=keep_composite_keys,
+                                         max_diffs=max_diffs, max_diffs_order=max_diffs_order,
+                                         keep_unmatched_key_strings=keep_unmatched_key_strings,
+                                         encoding=encoding)
 
-    return comparison_result  #TODO:  Is this line needed?  We're just relying on the shared obj here
+    return comparison_result
 
-def delim_diff(file_a: str, file_b: str, delimiter: str = None, composite_key_fields: list = None,
-               unimportant_fields:list = None , output_json: bool = False, verbose: bool = False,
-               use_multiprocessing: bool = True):
+def _process_bucket_with_id(bucket: dict) -> tuple:
+    """
+    process_bucket() for Pool.imap_unordered(), whose results arrive in any order
+    Returns: tuple of (bucket_id, comparison result)
+    """
+    ret_val = (bucket['bucket_id'], process_bucket(bucket))
+    return ret_val
+
+def _results_in_bucket_order(non_empty_buckets: list, finished_bucket_ids: set, checkpoint_dir: str,
+                             arriving_results):
+    """
+    Checkpoints bucket results as they arrive, in any order, and yields them in bucket order for the merge.  Buckets
+    finished by an earlier run are loaded from the checkpoint, and the ones diffed by this run are held in memory until
+    their turn, so they come back exactly as the workers returned them
+    :param non_empty_buckets: All the buckets, in bucket order
+    :param finished_bucket_ids: The ids of the buckets finished by an earlier run
+    :param checkpoint_dir: The checkpoint directory
+    :param arriving_results: iterable of (bucket_id, comparison result) for the other buckets, in the order they finish
+    :return: generator of comparison results, in bucket order
+    """
+    arriving_results = iter(arriving_results)
+    arrived_results = {}
+    for bucket in non_empty_buckets:
+        bucket_id = bucket['bucket_id']
+        if bucket_id in finished_bucket_ids:
+            yield load_bucket_result(checkpoint_dir, bucket_id)
+            continue
+
+        # Save everything that finishes while this bucket is waited for
+        while bucket_id not in arrived_results:
+            arrived_bucket_id, bucket_result = next(arriving_results)
+            save_bucket_result(checkpoint_dir, arrived_bucket_id, bucket_result)
+            arrived_results[arrived_bucket_id] = bucket_result
+        yield arrived_results.pop(bucket_id)
+
+def _print_summary(summary: dict, unimportant_fields: list):
+    """
+    Prints the [Summary] block
+    Args:
+        summary: The counters to print.  See comparison_result.COUNTER_NAMES
+        unimportant_fields: The fields that were skipped over
+    Returns:
+    """
+
+    print("\n\n[Summary]:")
+    if len(unimportant_fields) > 0:
+        print(f"--> SKIPPED over these unimportant fields: {unimportant_fields}")
+    print(f"Lines in File A: {summary['lines_in_file_a']}")
+    print(f"Lines in File B: {summary['lines_in_file_b']}")
+    print(f"Unique composite keys across both files: {summary['unique_composite_keys']}")
+    print(f"Total lines with diffs (Excluding Unimportant Fields): {summary['total_lines_with_diffs']}")
+    print(f"Total field level diffs (Excluding Unimportant Fields): {summary['field_level_diffs']}")
+    print(f"Total rows present in A but not in B: {summary['present_in_a_not_in_b']}")
+    print(f"Total rows present in B but not in A: {summary['present_in_b_not_in_a']}")
+    print(f"Total rows present in both A and B: {summary['matched_composite_keys']}")
+
+def _init_worker_logging(level: int):
+    """
+    Pool initializer.  Workers started with the spawn method (the default on macOS) don't inherit the logging setup
+    of the parent, so they'd otherwise drop their progress messages
     """
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=level, format='%(message)s', stream=sys.stdout)
+
+def _resolve_inputs(file_a: str, file_b: str, delimiter: str = None, composite_key_fields: list = None,
+                    unimportant_fields: list = None, verbose: bool = False, binary: bool = False,
+                    encoding: str = 'utf-8') -> dict:
+    """
+    Validates both files from their headers, and resolves the delimiter, composite key fields and unimportant fields
     :param file_a: The first delimited file to compare
     :param file_b: The second delimited file to compare
-    :param delimiter: The delimiter to use.  It nof passed, will be inferred
+    :param delimiter: The delimiter to use.  If not passed, will be inferred
     :param composite_key_fields: A list of fields to use as the composite key.  If not passed, the first matched field
-        This list of fields must be present in both files
-    :unimportant_fields: A list of fields to ignore when comparing rows
-    :param output_json: If True, will print the results as a JSON string to stderr.  This can be useful for piping
-        the results to another program.
-    :param verbose: If True, will print verbose output
-    :param use_multiprocessing: If True, multiprocessing will be used.  Note that multiprocessing is tremendously faster
-        and should generally always be used unless this program is being debugged.
-    :return:  dict of comparison results
-    unimportant_fields : list = A list of fields to ignore when comparing rows
+    :param unimportant_fields: A list of fields to ignore when comparing rows
+    :param verbose: If True, will log verbose output
+    :param binary: If True, the headers are read as bytes and decoded with encoding
+    :param encoding: The encoding used to decode the headers in binary mode
+    :return: dict with the keys delimiter, composite_key_fields and unimportant_fields
     """
 
     """
@@ -67,11 +151,11 @@ def delim_diff(file_a: str, file_b: str, delimiter: str = None, composite_key_fi
     for file in files_list:
         if not os.path.isfile(file):
             raise ValueError(f"{file} is not an actual file!")
-        print(f"Validated that [{file}] is a real file.")
+        logger.info(f"Validated that [{file}] is a real file.")
 
-    # Load both files as strings
-    file_a_str = load_file_as_string(file_a)
-    file_b_str = load_file_as_string(file_b)
+    # Read the start of both files.  Enough for the header and the delimiter
+    file_a_str = read_sample(file_a, encoding if binary else None)
+    file_b_str = read_sample(file_b, encoding if binary else None)
 
     """
     # Handle the delimiter
@@ -88,12 +172,12 @@ def delim_diff(file_a: str, file_b: str, delimiter: str = None, composite_key_fi
                              f"program again")
         else:
             delimiter = _inferred_delimiter_a
-            print(f"Using inferred delimiter [{repr(delimiter)}]")
+            logger.info(f"Using inferred delimiter [{repr(delimiter)}]")
     else:
         if not type(delimiter) == str:
-            print(f"Delimiter [{delimiter}] is not a string, but will be treated as one.")
+            logger.info(f"Delimiter [{delimiter}] is not a string, but will be treated as one.")
             delimiter = str(delimiter)
-        print(f"Using specified delimiter [{repr(delimiter)}]")
+        logger.info(f"Using specified delimiter [{repr(delimiter)}]")
 
     """
     Handle the header records / composite key fields
@@ -104,43 +188,16 @@ def delim_diff(file_a: str, file_b: str, delimiter: str = None, composite_key_fi
     file_b_column_names = file_b_header.split(delimiter)
 
     # Compare the column names between files
-    matched_fields = []
-    unmatched_fields = []
-    for l in [file_a_column_names, file_b_column_names]:
-        other_list = file_b_column_names if l is file_a_column_names else file_a_column_names
-        for field in l:
-            if field in other_list:
-                if field not in matched_fields:
-                    matched_fields.append(field)
-            else:
-                if field not in unmatched_fields:
-                    unmatched_fields.append(field)
+    matched_fields, unmatched_fields = match_column_names(file_a_column_names, file_b_column_names)
 
     if verbose is True:
-        print(f"Matched fields: {matched_fields}")
-        print(f"Unmatched fields: {unmatched_fields}")
+        logger.info(f"Matched fields: {matched_fields}")
+        logger.info(f"Unmatched fields: {unmatched_fields}")
 
     """
     Handle the the composite key 
     """
-    # Ensure we're dealing with a list for composite_key_fields
-    if composite_key_fields is None:
-        composite_key_fields = []
-    if type(composite_key_fields) is not list:
-        composite_key_fields = [composite_key_fields]
-
-    # Default to the first matched field if none are specified
-    if not composite_key_fields:
-        composite_key_fields = [matched_fields[0]]
-        print(f"Will attempt to use [{composite_key_fields[0]}] as the composite key field since none were specified.  "
-              f"This is the first matched (leftmost) field between both data sets.")
-    else:
-        print(f"Using specified composite key fields {composite_key_fields}")
-
-    # Ensure that all composite key fields are in the matched fields
-    for field in composite_key_fields:
-        if not field in matched_fields:
-            raise ValueError(f"Composite key field [{field}] is not in the matched fields!")
+    composite_key_fields = resolve_composite_key_fields(composite_key_fields, matched_fields)
 
     """
     Handle unimportant fields
@@ -156,183 +213,316 @@ def delim_diff(file_a: str, file_b: str, delimiter: str = None, composite_key_fi
             raise ValueError(f"Unimportant field [{field}] is in the composite key fields!  "
                              f"If it is part of the key, it cannot be specified as unimportant, which causes it to be ignored.")
 
+    ret_val = dict(delimiter=delimiter,
+                   composite_key_fields=composite_key_fields,
+                   unimportant_fields=unimportant_fields)
+    return ret_val
+
+def _load_records(file_a: str, file_b: str, delimiter: str = None, composite_key_fields: list = None,
+                  unimportant_fields: list = None, verbose: bool = False, tokenizer: str = 'auto',
+                  binary: bool = False, encoding: str = 'utf-8', row_numbers_from_field: bool = False) -> dict:
     """
-    Load the files as dictionaries
+    Validates and reads both files into lists of dicts, and injects the composite key into every record
+    :param file_a: The first delimited file to compare
+    :param file_b: The second delimited file to compare
+    :param delimiter: The delimiter to use.  If not passed, will be inferred
+    :param composite_key_fields: A list of fields to use as the composite key.  If not passed, the first matched field
+    :param unimportant_fields: A list of fields to ignore when comparing rows
+    :param verbose: If True, will log verbose output
+    :param tokenizer: How the files are split into fields.  See tokenizer.TOKENIZERS
+    :param binary: If True, the values of the records are left as bytes.  Only the header is decoded, with encoding
+    :param encoding: The encoding used to decode the header (and later, the values that differ) in binary mode
+    :param row_numbers_from_field: If True, the row numbers come from the __row_number field.  See delim_diff()
+    :return: dict with the keys file_a_records, file_b_records and the resolved delimiter, composite_key_fields and
+        unimportant_fields
     """
-    file_a_dict_reader = csv.DictReader(io.StringIO(file_a_str), delimiter=delimiter)
-    file_b_dict_reader = csv.DictReader(io.StringIO(file_b_str), delimiter=delimiter)
+    inputs = _resolve_inputs(file_a=file_a, file_b=file_b, delimiter=delimiter,
+                             composite_key_fields=composite_key_fields, unimportant_fields=unimportant_fields,
+                             verbose=verbose, binary=binary, encoding=encoding)
+    delimiter = inputs['delimiter']
+    composite_key_fields = inputs['composite_key_fields']
+    unimportant_fields = inputs['unimportant_fields']
 
-    file_a_records = list(file_a_dict_reader)
-    file_b_records = list(file_b_dict_reader)
+    """
+    Load the files as dictionaries
+    """
+    file_a_records = read_records(file_a, delimiter, tokenizer, binary, encoding if binary else None)
+    file_b_records = read_records(file_b, delimiter, tokenizer, binary, encoding if binary else None)
 
     """
     Inject the composite key
     """
-    inject_composite_key(file_a_records, composite_key_fields)
-    inject_composite_key(file_b_records, composite_key_fields)
+    inject_composite_key(file_a_records, composite_key_fields, encoding=encoding,
+                         row_numbers_from_field=row_numbers_from_field)
+    inject_composite_key(file_b_records, composite_key_fields, encoding=encoding,
+                         row_numbers_from_field=row_numbers_from_field)
+
+    ret_val = dict(file_a_records=file_a_records,
+                   file_b_records=file_b_records,
+                   delimiter=delimiter,
+                   composite_key_fields=composite_key_fields,
+                   unimportant_fields=unimportant_fields)
+    return ret_val
+
+def _bucketize(file_a_records: list, file_b_records: list, **bucket_options) -> list:
+    """
+    Splits the records into buckets on the leading characters of their composite key hash.  Records with the same
+    composite key always land in the same bucket, so buckets can be compared independently
+    :param file_a_records: The records of File A, with the composite key injected
+    :param file_b_records: The records of File B, with the composite key injected
+    :param bucket_options: The options that process_bucket() reads from each bucket (unimportant_fields, verbose, ...)
+    :return: list of the non-empty buckets
+    """
+
+    buckets = _empty_buckets()
+
+    logger.info("Assigning records to buckets...")
+    bucket_char_width = len(list(buckets.keys())[0])
+    for rec_list in [file_a_records, file_b_records]:
+        for rec in rec_list:
+            bucket = rec['__composite_key_hash'][:bucket_char_width]
+            if rec_list is file_a_records:
+                buckets[bucket]['A'].append(rec)
+            else:
+                buckets[bucket]['B'].append(rec)
+
+    ret_val = _non_empty_buckets(buckets, **bucket_options)
+    return ret_val
+
+def _empty_buckets() -> dict:
+    """
+    Generates one empty bucket for every value of the leading characters of a composite key hash
+    :return: dict of bucket id -> bucket
+    """
+    logger.info("Generate empty buckets for batching...")
+    hex_chars = '0123456789abcdef'
+
+    # TODO:  Drop this block, which is replaced by fewer lines below
+    # buckets = {}
+    # for h1 in hex_chars:
+    #     for h2 in hex_chars:
+    #         for h3 in hex_chars:
+    #             bucket_id = f"{h1}{h2}{h3}"
+    #             buckets[bucket_id] = dict(bucket_id=bucket_id, A=[], B=[])
+
+    buckets = {f"{h1}{h2}{h3}": {'bucket_id': f"{h1}{h2}{h3}", 'A': [], 'B': []}
+           for h1, h2, h3 in product(hex_chars, repeat=3)}
+
+    ret_val = buckets
+    return ret_val
+
+def _non_empty_buckets(buckets: dict, **bucket_options) -> list:
+    """
+    Drops the empty buckets, and adds the options that process_bucket() reads to the rest
+    :param buckets: dict of bucket id -> bucket.  See _empty_buckets()
+    :param bucket_options: The options that process_bucket() reads from each bucket (unimportant_fields, verbose, ...)
+    :return: list of the non-empty buckets
+    """
+
+    # Empty buckets have nothing to compare, so they aren't worth shipping to a worker
+    non_empty_buckets = []
+    for bk in buckets.keys():
+        if buckets[bk]['A'] or buckets[bk]['B']:
+            buckets[bk].update(bucket_options)
+            non_empty_buckets.append(buckets[bk])
+
+    ret_val = non_empty_buckets
+    return ret_val
+
+def delim_diff(file_a: str, file_b: str, delimiter: str = None, composite_key_fields: list = None,
+               unimportant_fields:list = None , output_json: bool = False, verbose: bool = False,
+               use_multiprocessing: bool = True, return_summary: bool = False,
+               keep_composite_keys: bool = False, max_diffs: int = None, max_diffs_order: str = 'hash',
+               near_match_max_distance: int = None, tokenizer: str = 'auto', checkpoint_dir: str = None,
+               binary: bool = False, encoding: str = 'utf-8', pipelined: bool = False,
+               row_numbers_from_field: bool = False):
+    """
+    :param file_a: The first delimited file to compare
+    :param file_b: The second delimited file to compare
+    :param delimiter: The delimiter to use.  It nof passed, will be inferred
+    :param composite_key_fields: A list of fields to use as the composite key.  If not passed, the first matched field
+        This list of fields must be present in both files
+    :unimportant_fields: A list of fields to ignore when comparing rows
+    :param output_json: If True, will print the results as a JSON string to stderr.  This can be useful for piping
+        the results to another program.
+    :param verbose: If True, will print verbose output
+    :param use_multiprocessing: If True, multiprocessing will be used.  Note that multiprocessing is tremendously faster
+        and should generally always be used unless this program is being debugged.
+    :param return_summary: If True, returns a dict with the keys 'diffs' and 'summary' instead of just the diffs.
+        The summary holds the counters printed in the [Summary] block
+    :param keep_composite_keys: If True (and return_summary is True), the full lists of matched, unmatched and all
+        composite keys are also returned.  These are large, so they are only built when asked for
+    :param max_diffs: If passed, only this many diff records are kept and returned.  The summary counts are still
+        computed over all rows.  Useful when the files are so diverged that the full diffs would not fit in memory
+    :param max_diffs_order: Which records are kept when max_diffs is passed.  'hash' keeps the records with the
+        lowest composite key hashes (an arbitrary but stable sample), 'distance' keeps the records with the largest
+        total Levenshtein distance
+    :param near_match_max_distance: If passed, the composite keys found in only one file are paired up with keys from
+        the other file that are within this Levenshtein distance (e.g. typos).  The suggested pairings are printed
+        (and returned under 'near_matches' if return_summary is True)
+    :param tokenizer: How the files are split into fields.  'auto' (the default) splits files without quotes on the
+        delimiter directly, and uses the csv module otherwise.  See tokenizer.TOKENIZERS
+    :param checkpoint_dir: If passed, the result of every bucket is saved here as it finishes, and a run pointed at
+        the checkpoint of an earlier run with the same inputs and options only diffs the buckets that are left.
+        Requires multiprocessing.  The results of buckets finished by an earlier run are read back from JSON, so in
+        those, diff records keyed on None (fields past the end of the header) come back keyed on "null".  See
+        checkpoint.py
+    :param binary: If True, the files are read, split, keyed and compared as bytes, without decoding them.  Only the
+        values that differ are decoded, with encoding, for the diff records and Levenshtein distances.  For byte exact
+        comparisons, and for files with mixed encodings
+    :param encoding: The encoding used to decode the header and the values that differ in binary mode.  Anything that
+        doesn't decode is replaced rather than raising an error
+    :param pipelined: If True, both files are read at the same time by reader threads, while parser/hasher threads
+        turn what has been read so far into records and route them straight into their buckets.  Overlaps the reads
+        with the parsing, which cuts the wall time when reading is slow (e.g. network mounted storage).  Requires
+        multiprocessing.  See pipeline.py
+    :param row_numbers_from_field: If True, the row numbers reported for each record come from its __row_number
+        field instead of being counted.  Shard files carry the row numbers of the original files there.  See
+        sharding.py
+    :return:  dict of comparison results
+    unimportant_fields : list = A list of fields to ignore when comparing rows
+    """
+
+    """
+    Handle the diff retention limit
+    """
+    if max_diffs is not None and max_diffs < 0:
+        raise ValueError(f"Max diffs [{max_diffs}] must not be negative!")
+    if max_diffs_order not in MAX_DIFFS_ORDERS:
+        raise ValueError(f"Max diffs order [{max_diffs_order}] must be one of {MAX_DIFFS_ORDERS}!")
+    if checkpoint_dir is not None and use_multiprocessing is not True:
+        raise ValueError("Checkpointing saves the result of each bucket, so it needs multiprocessing!")
+    if pipelined is True and use_multiprocessing is not True:
+        raise ValueError("The pipeline loads the records straight into buckets, so it needs multiprocessing!")
+
+    # The near match stage needs the key strings of the unmatched records, which aren't kept otherwise
+    keep_unmatched_key_strings = near_match_max_distance is not None
+
+    bucket_options = dict(verbose=verbose,
+                          keep_composite_keys=keep_composite_keys,
+                          max_diffs=max_diffs,
+                          max_diffs_order=max_diffs_order,
+                          keep_unmatched_key_strings=keep_unmatched_key_strings,
+                          encoding=encoding)
+
+    """
+    Load the files and inject the composite key
+    """
+    if pipelined is True:
+        # Read, parse, key and bucketize both files at once.  See pipeline.py
+        records = _resolve_inputs(file_a=file_a, file_b=file_b, delimiter=delimiter,
+                                  composite_key_fields=composite_key_fields, unimportant_fields=unimportant_fields,
+                                  verbose=verbose, binary=binary, encoding=encoding)
+        unimportant_fields = records['unimportant_fields']
+        buckets = _empty_buckets()
+        load_into_buckets(file_a, file_b, buckets, records['delimiter'], records['composite_key_fields'],
+                          tokenizer=tokenizer, binary=binary, encoding=encoding if binary else None,
+                          row_numbers_from_field=row_numbers_from_field)
+        non_empty_buckets = _non_empty_buckets(buckets, unimportant_fields=unimportant_fields, **bucket_options)
+        del buckets
+    else:
+        records = _load_records(file_a=file_a, file_b=file_b, delimiter=delimiter,
+                                composite_key_fields=composite_key_fields, unimportant_fields=unimportant_fields,
+                                verbose=verbose, tokenizer=tokenizer, binary=binary, encoding=encoding,
+                                row_numbers_from_field=row_numbers_from_field)
+        file_a_records = records['file_a_records']
+        file_b_records = records['file_b_records']
+        unimportant_fields = records['unimportant_fields']
 
     """
     Bucketize the records for multiprocessing
     """
 
     if use_multiprocessing is True:
-        print("Generate empty buckets for batching...")
-        hex_chars = '0123456789abcdef'
-
-        # TODO:  Drop this block, which is replaced by fewer lines below
-        # buckets = {}
-        # for h1 in hex_chars:
-        #     for h2 in hex_chars:
-        #         for h3 in hex_chars:
-        #             bucket_id = f"{h1}{h2}{h3}"
-        #             buckets[bucket_id] = dict(bucket_id=bucket_id, A=[], B=[])
-
-        buckets = {f"{h1}{h2}{h3}": {'bucket_id': f"{h1}{h2}{h3}", 'A': [], 'B': []}
-               for h1, h2, h3 in product(hex_chars, repeat=3)}
-
-        print("Assigning records to buckets...")
-        bucket_char_width = len(list(buckets.keys())[0])
-        for rec_list in [file_a_records, file_b_records]:
-            for rec in rec_list:
-                bucket = rec['__composite_key_hash'][:bucket_char_width]
-                if rec_list is file_a_records:
-                    buckets[bucket]['A'].append(rec)
-                else:
-                    buckets[bucket]['B'].append(rec)
-                buckets[bucket]['unimportant_fields'] = unimportant_fields
-                buckets[bucket]['verbose'] = verbose
+        if pipelined is not True:
+            non_empty_buckets = _bucketize(file_a_records, file_b_records, unimportant_fields=unimportant_fields,
+                                           **bucket_options)
+
+        """
+        Skip the buckets that an earlier run already checkpointed
+        """
+        finished_bucket_ids = set()
+        if checkpoint_dir is not None:
+            checkpoint_manifest = make_checkpoint_manifest(
+                file_a, file_b, options=dict(delimiter=records['delimiter'],
+                                             composite_key_fields=records['composite_key_fields'],
+                                             unimportant_fields=unimportant_fields,
+                                             keep_composite_keys=keep_composite_keys,
+                                             max_diffs=max_diffs,
+                                             max_diffs_order=max_diffs_order,
+                                             keep_unmatched_key_strings=keep_unmatched_key_strings,
+                                             binary=binary,
+                                             encoding=encoding,
+                                             row_numbers_from_field=row_numbers_from_field))
+            finished_bucket_ids = open_checkpoint(checkpoint_dir, checkpoint_manifest)
+        pending_buckets = [bucket for bucket in non_empty_buckets if bucket['bucket_id'] not in finished_bucket_ids]
 
         """
         Do the comparison using multiprocessing
         """
-        print("Starting comparison...")
-
-        # Use Manager to create a shared object that the processes can all write to
-        manager = Manager()  # This allows us to share a results object between processes
-        _shared_results = manager.dict()
-        for bk in buckets.keys():
-            _shared_results[bk] = {}
-
-        # A pool for keeping track of worker processes
-        pool = Pool()
-        for bk in buckets.keys():
-            args = (buckets[bk], _shared_results)  # This must be a tuple, with positional arguments.  Chat GPT says so!
-            pool.apply_async(process_bucket, args=args)
-
-        pool.close()
-        pool.join()
-        shared_results = dict(_shared_results)  # Convert the shared results to a regular dict
-
-        # Assemble shared_results to match all_comparison_results
-        print("All processes have completed.  Collecting results...")
-
-        # Re-construct a single results object from the shared results
-        mp_all_comparison_results = {}
-        mp_all_comparison_results['diffs'] = {}
-        mp_all_comparison_results['unmatched_composite_keys_from_list_a'] = []
-        mp_all_comparison_results['unmatched_composite_keys_from_list_b'] = []
-        mp_all_comparison_results['matched_composite_keys'] = []
-        mp_all_comparison_results['all_composite_keys'] = []
-
-        for sr in shared_results.keys():
-            # if verbose is True:
-            #     print(f"Processing results for bucket {sr}...")  #TODO.  Drop this.  Who cares
-            rec = shared_results[sr]
-            _diffs = rec.get('diffs') or {}
-            _unmatched_composite_keys_from_list_a = rec.get('unmatched_composite_keys_from_list_a') or []
-            _unmatched_composite_keys_from_list_b = rec.get('unmatched_composite_keys_from_list_b') or []
-            _matched_composite_keys = rec.get('matched_composite_keys') or []
-            _all_composite_keys = rec.get('all_composite_keys') or []
-
-            mp_all_comparison_results['diffs'].update(_diffs)
-            mp_all_comparison_results['unmatched_composite_keys_from_list_a'].extend(_unmatched_composite_keys_from_list_a)
-            mp_all_comparison_results['unmatched_composite_keys_from_list_b'].extend(_unmatched_composite_keys_from_list_b)
-            mp_all_comparison_results['matched_composite_keys'].extend(_matched_composite_keys)
-            mp_all_comparison_results['all_composite_keys'].extend(_all_composite_keys)
+        logger.info(f"Starting comparison of {len(pending_buckets)} buckets...")
+
+        # Each worker returns a compact result for its bucket: the diffs plus pre-aggregated counters
+        comparison_result = new_comparison_result(keep_composite_keys=keep_composite_keys,
+                                                  keep_unmatched_key_strings=keep_unmatched_key_strings)
+        with Pool(initializer=_init_worker_logging, initargs=(logging.getLogger().level,)) as pool:
+            if checkpoint_dir is not None:
+                # Save every bucket the moment it finishes, in whatever order, so that a slow bucket doesn't hold the
+                # finished ones after it unsaved, where an interruption would lose them.  Merge in bucket order, so
+                # that the output is the same as for an uninterrupted run
+                bucket_results = _results_in_bucket_order(
+                    non_empty_buckets, finished_bucket_ids, checkpoint_dir,
+                    pool.imap_unordered(_process_bucket_with_id, pending_buckets))
+            else:
+                bucket_results = pool.imap(process_bucket, pending_buckets)
+
+            for bucket_result in bucket_results:
+                merge_comparison_results(comparison_result, bucket_result)
+
+                # Each bucket brings at most max_diffs records.  Trim now and then so the total stays bounded
+                if max_diffs is not None and len(comparison_result['diffs']) > 2 * max_diffs:
+                    comparison_result['diffs'] = trim_diffs(comparison_result['diffs'], max_diffs, max_diffs_order)
+
+        logger.info("All processes have completed.")
 
         # Report the results from the multiprocessing variant
         print("\n\n[Summary from Multiprocessing]:")
-        total_lines_with_diffs = len(mp_all_comparison_results['diffs'])
-        field_level_diffs_running_total = 0
-        present_in_a_not_in_b_running_total = 0
-        present_in_b_not_in_a_running_total = 0
-
-        for k in mp_all_comparison_results['diffs'].keys():
-            result = mp_all_comparison_results['diffs'][k]
-
-            # Count Field Level Diffs
-            field_level_diffs = result.get('__field_differences_count')
-            if field_level_diffs:
-                field_level_diffs_running_total += field_level_diffs
-
-            # Count Present in A not in B diffs
-            present_in_a_not_in_b = result.get('_record_present_in_A_not_in_B')
-            if present_in_a_not_in_b:
-                present_in_a_not_in_b_running_total += 1
-
-            # Count Present in B not in A diffs
-            present_in_b_not_in_a = result.get('_record_present_in_B_not_in_A')
-            if present_in_b_not_in_a:
-                present_in_b_not_in_a_running_total += 1
-
-        print("\n\n[Summary]:")
-        if len(unimportant_fields) > 0:
-            print(f"--> SKIPPED over these unimportant fields: {unimportant_fields}")
-        print(f"Lines in File A: {len(file_a_records)}")
-        print(f"Lines in File B: {len(file_b_records)}")
-        print(f"Unique composite keys across both files: {len(mp_all_comparison_results['all_composite_keys'])}")
-        print(f"Total lines with diffs (Excluding Unimportant Fields): {total_lines_with_diffs}")
-        print(f"Total field level diffs (Excluding Unimportant Fields): {field_level_diffs_running_total}")
-        print(f"Total rows present in A but not in B: {present_in_a_not_in_b_running_total}")
-        print(f"Total rows present in B but not in A: {present_in_b_not_in_a_running_total}")
-
-        ret_val = mp_all_comparison_results['diffs']
 
     else:
         # Single Process Comparison.  Normally, we'll want to avoid this except for debugging, because it's slow.
-        all_comparison_results = _make_comparison(list_of_dicts_a=file_a_records, list_of_dicts_b=file_b_records
-                                                  , unimportant_fields=unimportant_fields, verbose=verbose) # Compare A to B
-        comparison_results = all_comparison_results['diffs']
+        comparison_result = _make_comparison(list_of_dicts_a=file_a_records, list_of_dicts_b=file_b_records
+                                             , unimportant_fields=unimportant_fields, verbose=verbose
+                                             , keep_composite_keys=keep_composite_keys
+                                             , max_diffs=max_diffs, max_diffs_order=max_diffs_order
+                                             , keep_unmatched_key_strings=keep_unmatched_key_strings
+                                             , encoding=encoding) # Compare A to B
 
-        """
-        Report statistics about the diffs
-        """
-        total_lines_with_diffs = len(comparison_results)
-        field_level_diffs_running_total = 0
-        present_in_a_not_in_b_running_total = 0
-        present_in_b_not_in_a_running_total = 0
-
-        for k in comparison_results.keys():
-
-            result = comparison_results[k]
-
-            # Count Field Level Diffs
-            field_level_diffs = result.get('__field_differences_count')
-            if field_level_diffs:
-                field_level_diffs_running_total += field_level_diffs
-
-            # Count Present in A not in B diffs
-            present_in_a_not_in_b = result.get('_record_present_in_A_not_in_B')
-            if present_in_a_not_in_b:
-                present_in_a_not_in_b_running_total += 1
-
-            # Count Present in B not in A diffs
-            present_in_b_not_in_a = result.get('_record_present_in_B_not_in_A')
-            if present_in_b_not_in_a:
-                present_in_b_not_in_a_running_total += 1
-
-        print("\n\n[Summary]:")
-        if len(unimportant_fields) > 0:
-            print(f"--> SKIPPED over these unimportant fields: {unimportant_fields}")
-        print(f"Lines in File A: {len(file_a_records)}")
-        print(f"Lines in File B: {len(file_b_records)}")
-        print(f"Unique composite keys across both files: {len(all_comparison_results['all_composite_keys'])}")
-        print(f"Total lines with diffs (Excluding Unimportant Fields): {total_lines_with_diffs}")
-        print(f"Total field level diffs (Excluding Unimportant Fields): {field_level_diffs_running_total}")
-        print(f"Total rows present in A but not in B: {present_in_a_not_in_b_running_total}")
-        print(f"Total rows present in B but not in A: {present_in_b_not_in_a_running_total}")
-
-        ret_val = comparison_results
+    if max_diffs is not None:
+        comparison_result['diffs'] = trim_diffs(comparison_result['diffs'], max_diffs, max_diffs_order)
+
+    """
+    Report statistics about the diffs
+    """
+    summary = comparison_result['counters']
+    _print_summary(summary, unimportant_fields)
+    if max_diffs is not None:
+        print(f"--> Retained {len(comparison_result['diffs'])} of {summary['total_lines_with_diffs']} lines with diffs "
+              f"(max diffs = {max_diffs}, by {max_diffs_order})")
+
+    """
+    Pair up the unmatched keys that are near matches
+    """
+    if near_match_max_distance is not None:
+        near_matches = find_near_matches(key_strings_a=comparison_result['unmatched_key_strings_from_list_a'],
+                                         key_strings_b=comparison_result['unmatched_key_strings_from_list_b'],
+                                         max_distance=near_match_max_distance,
+                                         verbose=verbose)
+        print(f"\n\n[Near Matches]:  {len(near_matches)} composite keys present in only one file are within "
+              f"a Levenshtein distance of {near_match_max_distance} of a key in the other file")
+        for near_match in near_matches:
+            print(f"A [{near_match['A']}] ~ B [{near_match['B']}] (distance {near_match['distance']})")
+
+    ret_val = comparison_result['diffs']
 
     # Print the diffs as a JSON string if the user wants it
     if output_json is True:
@@ -340,13 +530,30 @@ def delim_diff(file_a: str, file_b: str, delimiter: str = None, composite_key_fi
         print(json.dumps(ret_val, indent=4), file=sys.stderr)
         print("\n\n[END Diff Results as JSON]:", file=sys.stderr)
 
+    if return_summary is True:
+        ret_val = dict(diffs=ret_val, summary=summary)
+        if keep_composite_keys is True:
+            for list_name in COMPOSITE_KEY_LIST_NAMES:
+                ret_val[list_name] = comparison_result[list_name]
+        if near_match_max_distance is not None:
+            ret_val['near_matches'] = near_matches
+
     return ret_val
 
 
 
 
+SHARDING_SUBCOMMANDS = ['shard', 'diff-shard', 'merge']
+
 if __name__ == '__main__':
 
+    # The shard, diff-shard and merge subcommands have their own command line.  See sharding.py
+    if len(sys.argv) > 1 and sys.argv[1] in SHARDING_SUBCOMMANDS:
+        logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+        from sharding import main as sharding_main
+        sharding_main(sys.argv[1:])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(description='Compare two delimited files.')
 
     parser.add_argument('--file-a', '-a',
@@ -383,6 +590,77 @@ if __name__ == '__main__':
                         action='store_true',
                         required=False,
                         help='Prints out the details of the comparison.')
+    parser.add_argument('--max-diffs', '-m',
+                        type=int,
+                        required=False,
+                        help='Keep only this many detailed diff records.  The summary counts are still exact.  '
+                             'Bounds memory use when the files are heavily diverged.')
+    parser.add_argument('--max-diffs-order',
+                        type=str,
+                        required=False,
+                        default='hash',
+                        choices=MAX_DIFFS_ORDERS,
+                        help='Which diff records to keep with --max-diffs: those with the lowest composite key hashes, '
+                             'an arbitrary but stable sample (hash), or the largest by Levenshtein distance (distance).  '
+                             'Default is hash.')
+    parser.add_argument('--near-match-distance', '-n',
+                        type=int,
+                        required=False,
+                        help='If specified, composite keys present in only one file are paired up with keys in the '
+                             'other file that are within this Levenshtein distance, e.g. to spot typos in keys.')
+    parser.add_argument('--summary-only',
+                        action='store_true',
+                        required=False,
+                        help='Only report the summary counts.  No detailed diff records are kept.')
+    parser.add_argument('--approx',
+                        action='store_true',
+                        required=False,
+                        help='With --summary-only, estimate the summary in a single streaming pass over each file '
+                             'using fixed size sketches (HyperLogLog and Bloom filters) instead of loading the files.  '
+                             'Each estimate is printed with its error bound.')
+    parser.add_argument('--approx-memory-mb',
+                        type=float,
+                        required=False,
+                        default=64,
+                        help='The memory budget for the sketches used by --approx, in megabytes.  Default is 64.')
+    parser.add_argument('--binary',
+                        action='store_true',
+                        required=False,
+                        help='Read, split, key and compare the files as bytes, without decoding them.  Only the '
+                             'fields that differ are decoded, with --encoding, for reporting.  For byte exact '
+                             'comparisons, and for legacy files with mixed encodings.')
+    parser.add_argument('--encoding',
+                        type=str,
+                        required=False,
+                        default='utf-8',
+                        help='With --binary, the encoding used to decode the header and the fields that differ.  '
+                             'Bytes that do not decode are replaced.  Default is utf-8.')
+    parser.add_argument('--keyless',
+                        action='store_true',
+                        required=False,
+                        help='Diff the files by row position instead of by composite key, for files with no reliable '
+                             'key.  Rows are hashed and aligned with a Myers diff, and inserted, deleted and changed '
+                             'rows are reported by row number.')
+    parser.add_argument('--tokenizer',
+                        type=str,
+                        required=False,
+                        default='auto',
+                        choices=TOKENIZERS,
+                        help='How the files are split into fields.  auto (the default) splits files with no quote '
+                             'characters on the delimiter directly, which is much faster than the csv module, and '
+                             'uses the csv module otherwise.  fast skips the check for quotes up front.  Both fall '
+                             'back to the csv module as soon as they find a quote.  csv always uses the csv module.')
+    parser.add_argument('--checkpoint-dir',
+                        type=str,
+                        required=False,
+                        help='Save the result of every bucket to this directory as it finishes.  If the run dies, '
+                             'running it again with the same inputs, options and checkpoint directory only diffs '
+                             'the buckets that were left.')
+    parser.add_argument('--pipelined',
+                        action='store_true',
+                        required=False,
+                        help='Read both files at the same time, and parse, key and bucket them while they are still '
+                             'being read.  Cuts the wall time when reading is slow, e.g. on network mounted storage.')
     parser.add_argument('--single-process', '-s',
                         action='store_true',
                         required=False,
@@ -390,8 +668,60 @@ if __name__ == '__main__':
                              '(Not recommended except for debugging.)')
 
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
     use_multiprocessing = not args.single_process
 
+    if args.summary_only is True:
+        # A summary only run keeps none of the diff records, so these have no effect
+        summary_only_conflicts = dict(max_diffs='--max-diffs', max_diffs_order='--max-diffs-order',
+                                      output_json='--output-json')
+        for arg_name, flag in summary_only_conflicts.items():
+            if getattr(args, arg_name) != parser.get_default(arg_name):
+                parser.error(f'--summary-only cannot be used together with {flag}')
+
+    if args.approx is True:
+        if args.summary_only is not True:
+            parser.error('--approx can only be used together with --summary-only')
+
+        # The sketches stream each file through the csv module and keep no diff records, so these have no effect
+        approx_conflicts = dict(output_json='--output-json', binary='--binary', tokenizer='--tokenizer',
+                                keyless='--keyless', near_match_distance='--near-match-distance',
+                                max_diffs='--max-diffs', checkpoint_dir='--checkpoint-dir', pipelined='--pipelined')
+        for arg_name, flag in approx_conflicts.items():
+            if getattr(args, arg_name) != parser.get_default(arg_name):
+                parser.error(f'--approx cannot be used together with {flag}')
+        from approximate_summary import approximate_summary
+        approximate_summary(file_a=args.file_a,
+                            file_b=args.file_b,
+                            delimiter=args.delimiter,
+                            composite_key_fields=args.composite_key_fields,
+                            unimportant_fields=args.unimportant_fields,
+                            memory_mb=args.approx_memory_mb,
+                            verbose=args.verbose)
+        sys.exit(0)
+
+    if args.keyless is True:
+        # Keyless diffs align whole files by row position, and report every diff, so these have no effect
+        keyless_conflicts = dict(composite_key_fields='--composite-key-fields', binary='--binary',
+                                 max_diffs='--max-diffs', summary_only='--summary-only',
+                                 near_match_distance='--near-match-distance', checkpoint_dir='--checkpoint-dir',
+                                 pipelined='--pipelined')
+        for arg_name, flag in keyless_conflicts.items():
+            if getattr(args, arg_name) != parser.get_default(arg_name):
+                parser.error(f'--keyless cannot be used together with {flag}')
+        from positional_diff import positional_diff
+        positional_diff(file_a=args.file_a,
+                        file_b=args.file_b,
+                        delimiter=args.delimiter,
+                        unimportant_fields=args.unimportant_fields,
+                        output_json=args.output_json,
+                        verbose=args.verbose,
+                        tokenizer=args.tokenizer)
+        sys.exit(0)
+
+    # A summary only run is an exact run that keeps none of the diff records
+    max_diffs = 0 if args.summary_only is True else args.max_diffs
+
     delim_diff(file_a=args.file_a,
                file_b=args.file_b,
                delimiter=args.delimiter,
@@ -399,7 +729,15 @@ if __name__ == '__main__':
                unimportant_fields=args.unimportant_fields,
                output_json=args.output_json,
                verbose=args.verbose,
-               use_multiprocessing=use_multiprocessing)
+               use_multiprocessing=use_multiprocessing,
+               max_diffs=max_diffs,
+               max_diffs_order=args.max_diffs_order,
+               near_match_max_distance=args.near_match_distance,
+               tokenizer=args.tokenizer,
+               checkpoint_dir=args.checkpoint_dir,
+               binary=args.binary,
+               encoding=args.encoding,
+               pipelined=args.pipelined)
 
 
 
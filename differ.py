@@ -0,0 +1,194 @@
+"""
+A library API for embedding delimited diffs in long running Python services.
+
+delim_diff() is built for the command line: it prints its report, starts a new worker pool on every call and only
+returns once every diff has been collected.  DelimDiffer instead owns one worker pool for its whole lifetime, logs
+rather than prints, and hands diffs back through a generator as buckets finish:
+
+    with DelimDiffer() as differ:
+        for composite_key_hash, diff_record in differ.iter_diffs('a.tsv', 'b.tsv', composite_key_fields=['id']):
+            handle(diff_record)
+        print(differ.summary())
+
+Only a bounded number of buckets are in flight at a time, so a slow consumer holds back the workers (backpressure)
+instead of letting finished results pile up in memory.  Buckets are handed back in the order they finish, so one slow
+bucket doesn't hold back the diffs of the buckets that finished after it.
+"""
+
+import os
+import queue
+import logging
+from multiprocessing import Pool
+from delim_diff import process_bucket
+from delim_diff import _load_records
+from delim_diff import _bucketize
+from delim_diff import _init_worker_logging
+from comparison_result import new_counters
+from comparison_result import merge_counters
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 0.1  # How often a generator waiting on a bucket checks that its pool hasn't been closed
+
+
+class DelimDiffer:
+    """
+    Diffs pairs of delimited files on a composite key, reusing one pool of worker processes across calls
+    """
+
+    def __init__(self, processes: int = None, use_multiprocessing: bool = True, max_buckets_in_flight: int = None):
+        """
+        :param processes: The number of worker processes.  Defaults to the number of CPUs
+        :param use_multiprocessing: If False, buckets are compared in the calling process.  Useful for debugging
+        :param max_buckets_in_flight: How many buckets may be queued or running in the pool at once.  Bounds the
+            memory held by results the caller hasn't consumed yet.  Defaults to 4 per worker process
+        """
+        self.processes = processes
+        self.use_multiprocessing = use_multiprocessing
+        self.max_buckets_in_flight = max_buckets_in_flight
+        self._pool = None
+        self._summary = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(terminate=exc_type is not None)
+        return False
+
+    def open(self):
+        """
+        Starts the worker pool.  Called by __enter__, or lazily by the first iter_diffs()
+        """
+        if self.use_multiprocessing is True and self._pool is None:
+            processes = self.processes or os.cpu_count() or 1
+            self._pool = Pool(processes=processes, initializer=_init_worker_logging,
+                              initargs=(logging.getLogger().level,))
+            if self.max_buckets_in_flight is None:
+                self.max_buckets_in_flight = 4 * processes
+            logger.info(f"Started a pool of {processes} worker processes")
+
+    def close(self, terminate: bool = False):
+        """
+        Shuts down the worker pool
+        :param terminate: If True, running buckets are abandoned rather than waited for
+        """
+        if self._pool is not None:
+            if terminate is True:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _next_finished_bucket(self, finished_buckets: queue.Queue, pool):
+        """
+        Waits for the next bucket result (or error) on finished_buckets
+        :return: The result, or None if pool was closed or terminated meanwhile.  A terminated task never reports back
+        """
+        while self._pool is pool:
+            try:
+                ret_val = finished_buckets.get(timeout=POLL_SECONDS)
+                return ret_val
+            except queue.Empty:
+                pass
+        ret_val = None
+        return ret_val
+
+    def iter_diffs(self, file_a: str, file_b: str, delimiter: str = None, composite_key_fields: list = None,
+                   unimportant_fields: list = None, verbose: bool = False, tokenizer: str = 'auto',
+                   binary: bool = False, encoding: str = 'utf-8'):
+        """
+        Diffs two files, yielding the diff records as the buckets they belong to finish, in the order they finish.
+        The summary counters are available from summary() once the generator is exhausted.  If the generator is
+        closed early, it waits for the buckets still in flight, so that they don't hold up the next call, unless the
+        pool was closed in the meantime.  Note that a worker killed in the middle of a bucket (e.g. out of memory) never
+        reports back, and multiprocessing.Pool gives no way to tell, so the generator then waits forever
+        :param file_a: The first delimited file to compare
+        :param file_b: The second delimited file to compare
+        :param delimiter: The delimiter to use.  If not passed, will be inferred
+        :param composite_key_fields: A list of fields to use as the composite key.  If not passed, the first matched
+            field
+        :param unimportant_fields: A list of fields to ignore when comparing rows
+        :param verbose: If True, will log verbose output
+        :param tokenizer: How the files are split into fields.  See tokenizer.TOKENIZERS
+        :param binary: If True, the files are compared as bytes, and only the values that differ are decoded.  See
+            delim_diff()
+        :param encoding: The encoding used to decode the values that differ in binary mode
+        :return: generator of (composite_key_hash, diff_record) tuples.  See comparison_algorithm._make_comparison()
+        """
+
+        self._summary = None
+        records = _load_records(file_a=file_a, file_b=file_b, delimiter=delimiter,
+                                composite_key_fields=composite_key_fields, unimportant_fields=unimportant_fields,
+                                verbose=verbose, tokenizer=tokenizer, binary=binary, encoding=encoding)
+        buckets = _bucketize(records['file_a_records'], records['file_b_records'],
+                             unimportant_fields=records['unimportant_fields'],
+                             verbose=verbose,
+                             keep_composite_keys=False,
+                             max_diffs=None,
+                             max_diffs_order='hash',
+                             keep_unmatched_key_strings=False,
+                             encoding=encoding)
+        del records  # The buckets hold the records now
+
+        summary = new_counters()
+        if self.use_multiprocessing is True:
+            self.open()
+            pool = self._pool
+
+            # Keep a bounded window of buckets in flight.  A new bucket is only submitted once the caller has consumed
+            # the results of one that finished.  Results (or errors) arrive on finished_buckets in the order the
+            # buckets finish
+            finished_buckets = queue.Queue()
+            in_flight = 0
+            buckets = iter(buckets)
+            try:
+                while True:
+                    for bucket in buckets:
+                        pool.apply_async(process_bucket, (bucket,), callback=finished_buckets.put,
+                                               error_callback=finished_buckets.put)
+                        in_flight += 1
+                        if in_flight >= self.max_buckets_in_flight:
+                            break
+                    if in_flight == 0:
+                        break
+
+                    bucket_result = self._next_finished_bucket(finished_buckets, pool)
+                    if bucket_result is None:
+                        raise ValueError("The worker pool was closed before all the buckets were diffed!")
+                    in_flight -= 1
+                    if isinstance(bucket_result, BaseException):
+                        raise bucket_result
+                    merge_counters(summary, bucket_result['counters'])
+                    yield from bucket_result['diffs'].items()
+            finally:
+                # Stopped early, or a bucket failed.  Let the buckets still in flight finish, so the pool is idle for
+                # the next call.  If the pool was closed (e.g. terminated by __exit__ on an error), they never will
+                while in_flight > 0 and self._next_finished_bucket(finished_buckets, pool) is not None:
+                    in_flight -= 1
+        else:
+            for bucket in buckets:
+                bucket_result = process_bucket(bucket)
+                merge_counters(summary, bucket_result['counters'])
+                yield from bucket_result['diffs'].items()
+
+        logger.info(f"Diffed [{file_a}] and [{file_b}]: {summary['total_lines_with_diffs']} lines with diffs")
+        self._summary = summary
+
+    def diff(self, file_a: str, file_b: str, **kwargs) -> dict:
+        """
+        Convenience wrapper that collects iter_diffs() into a dict keyed on composite key hash
+        """
+        ret_val = dict(self.iter_diffs(file_a, file_b, **kwargs))
+        return ret_val
+
+    def summary(self) -> dict:
+        """
+        The summary counters of the last completed iter_diffs().  See comparison_result.COUNTER_NAMES
+        """
+        if self._summary is None:
+            raise ValueError("No summary is available yet!  Consume iter_diffs() to the end first.")
+        ret_val = dict(self._summary)
+        return ret_val
@@ -3,7 +3,11 @@ Helper functions for the main program
 """
 
 import os
+import csv
 import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
 
 def load_file_as_string(file_name:str) -> str:
     """
@@ -23,6 +27,14 @@ def load_file_as_string(file_name:str) -> str:
     ret_val = file_str
     return ret_val
 
+def detect_quoting(input_string:str, quote_char:str = '"') -> bool:
+    """
+    Detects whether a sample of a delimited file uses quoting.  Files without a single quote character can be split
+    on the delimiter directly, without going through the csv module
+    """
+    ret_val = quote_char in input_string
+    return ret_val
+
 def infer_delimiter(input_string:str) -> str:
     """
     Infers the delimiter of a delimited file
@@ -49,11 +61,146 @@ def infer_delimiter(input_string:str) -> str:
         ret_val = best_guess_delimiter
         return ret_val
 
-def inject_composite_key(data_object, composite_keys, verbose=False):
+def read_headers(file_a:str, file_b:str, delimiter:str = None) -> tuple:
+    """
+    Reads just the header rows of both files, for code paths that stream the files rather than load them
+    :param file_a: The first delimited file
+    :param file_b: The second delimited file
+    :param delimiter: The delimiter to use.  If not passed, will be inferred from the headers
+    :return: tuple of (delimiter, column_names_a, column_names_b)
+    """
+    headers = []
+    for file in [file_a, file_b]:
+        if not os.path.isfile(file):
+            raise ValueError(f"{file} is not an actual file!")
+        with open(file, 'r', newline='') as f:
+            headers.append(f.readline().rstrip('\r\n'))
+
+    if not delimiter:
+        _inferred_delimiter_a = infer_delimiter(headers[0])
+        _inferred_delimiter_b = infer_delimiter(headers[1])
+        if _inferred_delimiter_a != _inferred_delimiter_b:
+            raise ValueError(f"The inferred delimiters are different!  [{_inferred_delimiter_a}] and "
+                             f"[{_inferred_delimiter_b}].  Please explicitly specify a delimiter then call the "
+                             f"program again")
+        delimiter = _inferred_delimiter_a
+        logger.info(f"Using inferred delimiter [{repr(delimiter)}]")
+
+    column_names_a = next(csv.reader([headers[0]], delimiter=delimiter))
+    column_names_b = next(csv.reader([headers[1]], delimiter=delimiter))
+
+    ret_val = (delimiter, column_names_a, column_names_b)
+    return ret_val
+
+def match_column_names(column_names_a:list, column_names_b:list) -> tuple:
+    """
+    Compares the column names of two files
+    :param column_names_a: The column names from the header of File A
+    :param column_names_b: The column names from the header of File B
+    :return: tuple of (matched_fields, unmatched_fields), both in order of first appearance
+    """
+    matched_fields = []
+    unmatched_fields = []
+    for l in [column_names_a, column_names_b]:
+        other_list = column_names_b if l is column_names_a else column_names_a
+        for field in l:
+            if field in other_list:
+                if field not in matched_fields:
+                    matched_fields.append(field)
+            else:
+                if field not in unmatched_fields:
+                    unmatched_fields.append(field)
+
+    ret_val = (matched_fields, unmatched_fields)
+    return ret_val
+
+def resolve_composite_key_fields(composite_key_fields, matched_fields:list) -> list:
+    """
+    Validates the composite key fields, defaulting to the first matched field if none are specified
+    :param composite_key_fields: A field or list of fields to use as the composite key.  May be None
+    :param matched_fields: The fields found in both files.  See match_column_names()
+    :return: list of composite key fields
+    """
+
+    # Ensure we're dealing with a list for composite_key_fields
+    if composite_key_fields is None:
+        composite_key_fields = []
+    if type(composite_key_fields) is not list:
+        composite_key_fields = [composite_key_fields]
+
+    # Default to the first matched field if none are specified
+    if not composite_key_fields:
+        composite_key_fields = [matched_fields[0]]
+        logger.info(f"Will attempt to use [{composite_key_fields[0]}] as the composite key field since none were specified.  "
+              f"This is the first matched (leftmost) field between both data sets.")
+    else:
+        logger.info(f"Using specified composite key fields {composite_key_fields}")
+
+    # Ensure that all composite key fields are in the matched fields
+    for field in composite_key_fields:
+        if not field in matched_fields:
+            raise ValueError(f"Composite key field [{field}] is not in the matched fields!")
+
+    ret_val = composite_key_fields
+    return ret_val
+
+def make_composite_key(_dict:dict, composite_keys:list, encoding:str = 'utf-8') -> tuple:
+    """
+    Concatenates and hashes (sha-256) the composite keys found in a single dictionary
+    :param _dict: A single record
+    :param composite_keys: The fields that make up the composite key
+    :param encoding: Only used for records read in binary mode, whose values are bytes.  Their key is hashed as
+        bytes, and only decoded (with this encoding) for the composite key string that ends up in reports
+    :return: tuple of (composite_key_string, composite_key_hash)
+    """
+    for composite_key in composite_keys:
+        if composite_key not in _dict.keys():
+            raise ValueError(f"Composite key [{composite_key}] is not in the dictionary!  Keys found: [{_dict.keys()}]")
+
+    # Binary mode.  Same key as below for ASCII keys, but without the decode/encode round trip
+    if any(isinstance(_dict[composite_key], bytes) for composite_key in composite_keys):
+        composite_key_bytes = b'+'.join(b'None' if _dict[composite_key] is None else _dict[composite_key]
+                                        for composite_key in composite_keys)
+        if composite_key_bytes == b"":
+            raise ValueError(f"Failed to create a composite key string for [{_dict}]")
+        composite_key_bytes = composite_key_bytes.lower().strip()
+        composite_key_hash = hashlib.sha256(composite_key_bytes).hexdigest()
+        composite_key_string = composite_key_bytes.decode(encoding, errors='replace')
+
+        ret_val = (composite_key_string, composite_key_hash)
+        return ret_val
+
+    composite_key_string = ""
+    for composite_key in composite_keys:
+        if composite_key_string == "":
+            composite_key_string += str(_dict[composite_key])
+        else:
+            composite_key_string += f"+{str(_dict[composite_key])}"
+
+    if composite_key_string == "":
+        raise ValueError(f"Failed to create a composite key string for [{_dict}]")
+
+    composite_key_string = composite_key_string.lower().strip()
+
+    # Hash the composite key string
+    sha256_hash = hashlib.sha256()
+    sha256_hash.update(composite_key_string.encode('utf-8'))
+    composite_key_hash = sha256_hash.hexdigest()
+
+    ret_val = (composite_key_string, composite_key_hash)
+    return ret_val
+
+def inject_composite_key(data_object, composite_keys, verbose=False, encoding='utf-8', first_row_number=2,
+                         row_numbers_from_field=False):
     """
     Concatenates and hashes (sha-256) the composite keys found in some dictionary to create a key
     This key is written into the dictionary
     :type data_object: A list of dicts or a dict
+    :param encoding: Used to decode the composite key string of records read in binary mode.  See make_composite_key()
+    :param first_row_number: The row number of the first dict.  Callers that inject a file a batch at a time pass the
+        row number the batch starts on
+    :param row_numbers_from_field: If True, each dict's row number is taken from its __row_number field instead of
+        being counted.  Shard files carry the row numbers of the original files in that field.  See sharding.py
     """
 
     """
@@ -71,7 +218,7 @@ def inject_composite_key(data_object, composite_keys, verbose=False):
     """
     Inject the composite key into the data object
     """
-    row_number = 2 # First data row in a fle will be on row 2. Note.  Prior to Python 3.7, dictionaries were not guaranteed to be ordered.  This could be unreliable on older versions of python
+    row_number = first_row_number # First data row in a fle will be on row 2. Note.  Prior to Python 3.7, dictionaries were not guaranteed to be ordered.  This could be unreliable on older versions of python
 
     for _dict in data_object:
 
@@ -79,27 +226,10 @@ def inject_composite_key(data_object, composite_keys, verbose=False):
         if not type(_dict) is dict:
             raise ValueError(f"Data object [{_dict}] is not a dictionary!  It's a [{type(_dict)}]!")
 
-        composite_key_string = ""
-        for composite_key in composite_keys:
-            if composite_key not in _dict.keys():
-                raise ValueError(f"Composite key [{composite_key}] is not in the dictionary!  Keys found: [{_dict.keys()}]")
-            if composite_key_string == "":
-                composite_key_string += str(_dict[composite_key])
-            else:
-                composite_key_string += f"+{str(_dict[composite_key])}"
-
-        if composite_key_string == "":
-            raise ValueError(f"Failed to create a composite key string for [{_dict}]")
-
-        composite_key_string = composite_key_string.lower().strip()
-
-        # Hash the composite key string
-        sha256_hash = hashlib.sha256()
-        sha256_hash.update(composite_key_string.encode('utf-8'))
-        composite_key_hash = sha256_hash.hexdigest()
+        composite_key_string, composite_key_hash = make_composite_key(_dict, composite_keys, encoding)
 
         if verbose is True:
-            print(f"Calculated composite key hash [{composite_key_hash}] for composite key string [{composite_key_string}]")
+            logger.info(f"Calculated composite key hash [{composite_key_hash}] for composite key string [{composite_key_string}]")
 
         # Inject the composite key hash into the dictionary
         for new_keys in ['__composite_key_hash', '__composite_key_string']:
@@ -107,7 +237,10 @@ def inject_composite_key(data_object, composite_keys, verbose=False):
                 raise ValueError(f"Key [{new_keys}] already exists in the dictionary!")
         _dict['__composite_key_hash'] = composite_key_hash
         _dict['__composite_key_string'] = composite_key_string
-        _dict['__row_number'] = row_number
+        if row_numbers_from_field is True:
+            _dict['__row_number'] = int(_dict['__row_number'])
+        else:
+            _dict['__row_number'] = row_number
 
         row_number += 1
 
@@ -0,0 +1,132 @@
+"""
+Pairs up composite keys that are present in only one file but differ from a key in the other file by a typo or
+formatting change.
+
+Scoring every A-only key against every B-only key is O(n*m) Levenshtein calls.  Instead, each key is cut into
+padded q-grams (substrings of length q), and candidates are only scored if they survive these filters:
+
+    prefix filter  Every edit destroys at most q q-grams, so two keys within max_distance edits must share at least
+                   one of their (max_distance * q + 1) rarest q-grams.  Only those q-grams are indexed, which keeps
+                   the posting lists short
+    length filter  The lengths can differ by at most max_distance
+
+The survivors are verified with the Levenshtein distance, which we already depend on.  It is given max_distance as a
+cutoff, so it gives up early on pairs that are too far apart.
+
+Keys so short that they could be within max_distance edits without sharing any q-gram at all are compared against the
+other short keys directly.
+"""
+
+import logging
+from collections import Counter
+from collections import defaultdict
+from Levenshtein import distance as levenshtein_distance
+
+logger = logging.getLogger(__name__)
+
+PADDING_CHAR = '\x00'  # Will not occur in a composite key string read from a delimited text file
+
+
+def _qgrams(key_string: str, ngram_size: int) -> Counter:
+    """
+    Cuts a string into its padded q-grams.  Padding means that short strings still have q-grams to match on, and that
+    a string of length L always has L + q - 1 of them
+    :return: Counter of q-gram -> number of occurrences
+    """
+    padding = PADDING_CHAR * (ngram_size - 1)
+    padded = f"{padding}{key_string}{padding}"
+    ret_val = Counter(padded[i:i + ngram_size] for i in range(len(padded) - ngram_size + 1))
+    return ret_val
+
+def _prefix_tokens(qgrams: Counter, token_frequency: Counter, prefix_length: int) -> list:
+    """
+    Returns the prefix_length rarest q-gram tokens of a string.  A token is a (q-gram, occurrence number) pair, so
+    repeated q-grams are treated as distinct tokens
+    """
+    tokens = [(gram, occurrence) for gram, count in qgrams.items() for occurrence in range(count)]
+    tokens.sort(key=lambda token: (token_frequency[token], token))
+    ret_val = tokens[:prefix_length]
+    return ret_val
+
+def find_near_matches(key_strings_a: list, key_strings_b: list, max_distance: int = 2, ngram_size: int = 3,
+                      verbose: bool = False) -> list:
+    """
+    Suggests pairings between keys found only in File A and keys found only in File B
+    :param key_strings_a: The unmatched composite key strings from File A
+    :param key_strings_b: The unmatched composite key strings from File B
+    :param max_distance: The largest Levenshtein distance that is still considered a near match
+    :param ngram_size: The length of the q-grams used for blocking
+    :param verbose: If True, will print verbose output
+    :return: list of dicts with the keys A, B and distance.  Each key is used in at most one pairing, closest first
+    """
+
+    if max_distance < 0:
+        raise ValueError(f"Max distance [{max_distance}] must not be negative!")
+    if ngram_size < 1:
+        raise ValueError(f"N-gram size [{ngram_size}] must be at least 1!")
+
+    qgrams_a = [_qgrams(k, ngram_size) for k in key_strings_a]
+    qgrams_b = [_qgrams(k, ngram_size) for k in key_strings_b]
+
+    # Order tokens from rarest to most common across both files, so that the prefixes are as selective as possible
+    token_frequency = Counter()
+    for qgrams in qgrams_a + qgrams_b:
+        for gram, count in qgrams.items():
+            for occurrence in range(count):
+                token_frequency[(gram, occurrence)] += 1
+
+    prefix_length = max_distance * ngram_size + 1
+
+    # Two keys no longer than this can be a near match while sharing no q-grams, so the filters don't apply to them
+    short_key_length = max_distance * ngram_size - ngram_size + 1
+    short_b_indexes = [b_index for b_index, k in enumerate(key_strings_b) if len(k) <= short_key_length]
+
+    # Index File B on its prefix tokens
+    index = defaultdict(list)
+    for b_index, qgrams in enumerate(qgrams_b):
+        for token in _prefix_tokens(qgrams, token_frequency, prefix_length):
+            index[token].append(b_index)
+
+    """
+    Probe the index with File A and verify the survivors
+    """
+    candidate_pairs = []
+    candidates_scored = 0
+    for a_index, qgrams in enumerate(qgrams_a):
+        key_string_a = key_strings_a[a_index]
+
+        candidates = set()
+        for token in _prefix_tokens(qgrams, token_frequency, prefix_length):
+            candidates.update(index.get(token, []))
+        if len(key_string_a) <= short_key_length:
+            candidates.update(short_b_indexes)
+
+        for b_index in candidates:
+            key_string_b = key_strings_b[b_index]
+
+            # Length filter
+            if abs(len(key_string_a) - len(key_string_b)) > max_distance:
+                continue
+
+            candidates_scored += 1
+            _distance = levenshtein_distance(key_string_a, key_string_b, score_cutoff=max_distance)
+            if _distance <= max_distance:
+                candidate_pairs.append((_distance, key_string_a, key_string_b))
+
+    if verbose is True:
+        logger.info(f"Scored {candidates_scored} candidate pairs out of a possible "
+              f"{len(key_strings_a) * len(key_strings_b)} for near matches")
+
+    # Greedily pair up the closest keys first.  Each key may only be used once
+    candidate_pairs.sort()
+    used_a = set()
+    used_b = set()
+    ret_val = []
+    for _distance, key_string_a, key_string_b in candidate_pairs:
+        if key_string_a in used_a or key_string_b in used_b:
+            continue
+        used_a.add(key_string_a)
+        used_b.add(key_string_b)
+        ret_val.append(dict(A=key_string_a, B=key_string_b, distance=_distance))
+
+    return ret_val
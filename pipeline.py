@@ -0,0 +1,193 @@
+"""
+Loads both files into buckets with overlapping stages, instead of reading, parsing, keying and bucketing one file
+after the other.
+
+    reader A --[bounded queue]--> parser/hasher A --+
+                                                    +--> buckets
+    reader B --[bounded queue]--> parser/hasher B --+
+
+Each reader thread reads its file in chunks of whole lines and hands them to its parser/hasher thread through a
+bounded queue.  The parser/hasher splits each chunk (see tokenizer.py), builds the records, injects the composite key
+and routes every record straight into its bucket.  Reads release the GIL, so while one chunk is being parsed the next
+ones are already being read, for both files at once.  This is where the time goes on network mounted storage, where
+reading is the slow part.  The queues are bounded, so a reader never gets more than QUEUE_SIZE_CHUNKS ahead of its
+parser, however fast the storage is.  Files that need the csv module (quoting) are streamed through it too, a batch
+of rows at a time.
+
+A record's bucket comes from its composite key hash, so any record can land in any bucket: no bucket is complete
+until both files have been read to the end.  The comparison of the buckets starts right after that.
+
+The records, their row numbers and their order within each bucket are the same as for _load_records() followed by
+_bucketize() in delim_diff.py, so the diffs are too.
+"""
+
+import queue
+import locale
+import logging
+import threading
+from itertools import chain
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from helpers import detect_quoting
+from helpers import inject_composite_key
+from tokenizer import _gc_paused
+from tokenizer import _split_batch
+from tokenizer import _iter_csv_rows
+from tokenizer import _decode_header
+from tokenizer import _rows_to_records
+from tokenizer import TOKENIZERS
+from tokenizer import QUOTE_CHAR
+from tokenizer import SAMPLE_SIZE_BYTES
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE_BYTES = 1 << 22  # How much of a file a reader thread reads at a time
+QUEUE_SIZE_CHUNKS = 8  # How many chunks a reader thread may get ahead of its parser/hasher thread
+CSV_BATCH_SIZE_ROWS = 1 << 14  # How many rows the parser/hasher takes from the csv module at a time
+QUEUE_TIMEOUT_SECONDS = 0.1  # How often a blocked thread checks whether the other stages have failed
+
+
+def _read_chunks(file_name: str, chunk_queue: queue.Queue, abort: threading.Event):
+    """
+    The reader stage.  Reads a file in chunks that end on a newline and puts them on chunk_queue, followed by None
+    """
+
+    def put(chunk):
+        while not abort.is_set():
+            try:
+                chunk_queue.put(chunk, timeout=QUEUE_TIMEOUT_SECONDS)
+                return
+            except queue.Full:
+                pass
+
+    carry = b''
+    with open(file_name, 'rb') as f:
+        while not abort.is_set():
+            data = f.read(CHUNK_SIZE_BYTES)
+            if not data:
+                break
+
+            # Hold back the partial line at the end, so that every chunk is made of whole lines
+            end = data.rfind(b'\n') + 1
+            if end == 0:
+                carry += data
+                continue
+            put(carry + data[:end])
+            carry = data[end:]
+
+    if carry:
+        put(carry)
+    put(None)
+
+def _iter_chunks(chunk_queue: queue.Queue, abort: threading.Event):
+    """
+    Yields the chunks that a reader thread puts on chunk_queue, until its None
+    """
+    while not abort.is_set():
+        try:
+            chunk = chunk_queue.get(timeout=QUEUE_TIMEOUT_SECONDS)
+        except queue.Empty:
+            continue
+        if chunk is None:
+            return
+        yield chunk
+
+def _parse_chunks(file_name: str, side: str, chunk_queue: queue.Queue, abort: threading.Event, buckets: dict,
+                  delimiter: str, composite_key_fields: list, tokenizer: str, binary: bool, encoding: str,
+                  row_numbers_from_field: bool) -> int:
+    """
+    The parser/hasher stage.  Turns the chunks of a file into records, injects the composite key and appends each
+    record to its bucket
+    :param side: 'A' or 'B', the side of the buckets that the records are appended to
+    :return: The number of records read
+    """
+    split_encoding = encoding or locale.getpreferredencoding(False)
+    bucket_char_width = len(next(iter(buckets)))
+    header = None
+    row_number = 2  # First data row in a file will be on row 2
+    use_csv = tokenizer == 'csv'
+
+    def add_rows(rows: list):
+        nonlocal header, row_number
+        if header is None:
+            if not rows:
+                return
+            header = _decode_header(rows[0], encoding, binary)
+            rows = rows[1:]
+
+        records = _rows_to_records(header, rows)
+        inject_composite_key(records, composite_key_fields, encoding=encoding or 'utf-8',
+                             first_row_number=row_number, row_numbers_from_field=row_numbers_from_field)
+        row_number += len(records)
+        for rec in records:
+            buckets[rec['__composite_key_hash'][:bucket_char_width]][side].append(rec)
+
+    chunks = _iter_chunks(chunk_queue, abort)
+    for chunk in chunks:
+        if tokenizer == 'auto' and header is None:
+            use_csv = detect_quoting(chunk[:SAMPLE_SIZE_BYTES].decode(split_encoding, errors='ignore'), QUOTE_CHAR)
+            logger.info(f"Reading [{file_name}] with the {'csv' if use_csv else 'fast'} tokenizer"
+                        f"{' in binary mode' if binary else ''}")
+
+        rows = None if use_csv else _split_batch(chunk, delimiter, split_encoding, binary)
+        if rows is None:
+            # Same as the fast path of tokenizer.read_rows(): the csv module takes the rest of the file.  It is fed
+            # the chunks as they arrive, and its rows are taken a batch at a time, so parsing still overlaps reading
+            if not use_csv:
+                logger.info(f"Found a quote character or a bare carriage return in [{file_name}] after "
+                            f"{row_number - 2} rows.  Falling back to the csv module for the rest of the file")
+            csv_rows = _iter_csv_rows(chain([chunk], chunks), delimiter, split_encoding, binary)
+            for rows in iter(lambda: list(islice(csv_rows, CSV_BATCH_SIZE_ROWS)), []):
+                add_rows(rows)
+            break
+
+        add_rows(rows)
+
+    ret_val = row_number - 2
+    return ret_val
+
+def load_into_buckets(file_a: str, file_b: str, buckets: dict, delimiter: str, composite_key_fields: list,
+                      tokenizer: str = 'auto', binary: bool = False, encoding: str = None,
+                      row_numbers_from_field: bool = False):
+    """
+    Reads both files at the same time, and appends their records to the A and B sides of buckets
+    :param file_a: The first delimited file to compare
+    :param file_b: The second delimited file to compare
+    :param buckets: dict of bucket id -> bucket, with empty A and B lists.  See delim_diff._empty_buckets()
+    :param delimiter: The delimiter to split on
+    :param composite_key_fields: The fields of the composite key
+    :param tokenizer: One of tokenizer.TOKENIZERS
+    :param binary: If True, the values are bytes.  See tokenizer.read_records()
+    :param encoding: The encoding of the files.  See tokenizer.read_rows()
+    :param row_numbers_from_field: If True, the row numbers come from the __row_number field.  See delim_diff()
+    """
+    if tokenizer not in TOKENIZERS:
+        raise ValueError(f"Tokenizer [{tokenizer}] must be one of {TOKENIZERS}!")
+
+    # Any stage that fails sets abort, so the stages blocked on a queue give up instead of waiting forever
+    abort = threading.Event()
+
+    def run_stage(function, *args):
+        try:
+            ret_val = function(*args)
+            return ret_val
+        except BaseException:
+            abort.set()
+            raise
+
+    # The threads share one pause of the garbage collector for the whole load.  See tokenizer._gc_paused()
+    with _gc_paused(), ThreadPoolExecutor(max_workers=4, thread_name_prefix='pipeline') as executor:
+        stages = []
+        for file_name, side in [(file_a, 'A'), (file_b, 'B')]:
+            chunk_queue = queue.Queue(maxsize=QUEUE_SIZE_CHUNKS)
+            stages.append(executor.submit(run_stage, _read_chunks, file_name, chunk_queue, abort))
+            stages.append(executor.submit(run_stage, _parse_chunks, file_name, side, chunk_queue, abort, buckets,
+                                          delimiter, composite_key_fields, tokenizer, binary, encoding,
+                                          row_numbers_from_field))
+
+        # Raises the first error of any stage
+        for stage in stages:
+            stage.result()
+
+    logger.info(f"Loaded {stages[1].result()} records from [{file_a}] and {stages[3].result()} records from "
+                f"[{file_b}] into buckets")
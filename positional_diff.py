@@ -0,0 +1,315 @@
+"""
+Diffs two delimited files by row position, for files that have no reliable composite key.
+
+Each row is reduced to a single integer (the hash of its compared fields), and the two sequences of row hashes are
+aligned with Myers' O(ND) difference algorithm, using the linear space "middle snake" variant.  N is the number of
+rows and D the number of inserted plus deleted rows, so files that are mostly the same are aligned in close to
+linear time.  Rows that occur in only one file are dropped before aligning, so changed rows don't add to D either.
+Rows the alignment leaves over are reported as:
+
+    changed   A deleted row and an inserted row at the same spot in the alignment.  These get field level detail
+    deleted   Rows present in A but not in B
+    inserted  Rows present in B but not in A
+
+The diff records follow the same shape as the keyed diff (see comparison_algorithm._make_comparison), but are keyed
+on row numbers, e.g. 'A12:B13' for a changed row, 'A12' for a deleted row and 'B13' for an inserted row.
+"""
+
+import sys
+import json
+import logging
+from bisect import bisect_left
+from bisect import bisect_right
+from operator import itemgetter
+from itertools import compress
+from Levenshtein import distance as levenshtein_distance
+from helpers import read_headers
+from helpers import match_column_names
+from comparison_result import new_counters
+from tokenizer import read_rows
+
+logger = logging.getLogger(__name__)
+
+
+def _common_run_length(a: list, a_start: int, b: list, b_start: int, limit: int, step: int = 1) -> int:
+    """
+    Counts how many rows match walking from a[a_start] and b[b_start] in the given direction (1 forward, -1 backward),
+    up to limit rows.  Snakes through mostly equal files are long, so the rows are compared in galloping chunks using
+    list slice comparisons (which run in C) rather than one at a time
+    """
+    ret_val = 0
+    chunk = 1
+    while ret_val < limit:
+        chunk = min(chunk, limit - ret_val)
+        if step == 1:
+            i = a_start + ret_val
+            j = b_start + ret_val
+            equal = a[i:i + chunk] == b[j:j + chunk]
+        else:
+            i = a_start - ret_val + 1
+            j = b_start - ret_val + 1
+            equal = a[i - chunk:i] == b[j - chunk:j]
+        if equal:
+            ret_val += chunk
+            chunk *= 2
+        elif chunk > 1:
+            chunk = 1  # The mismatch is somewhere in this chunk.  Start galloping again from the last match
+        else:
+            break
+    return ret_val
+
+def _middle_snake(a: list, a_lo: int, a_hi: int, b: list, b_lo: int, b_hi: int) -> tuple:
+    """
+    Finds the middle snake of an optimal path through the edit graph of a[a_lo:a_hi] and b[b_lo:b_hi], by running
+    the greedy forward and backward searches at the same time until they overlap
+    :return: tuple of (D, x, y, u, v).  D is the length of the shortest edit script, and (x, y) -> (u, v) is the
+        snake, relative to a_lo and b_lo
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta % 2 == 1
+    forward = {1: 0}  # Furthest x reached on each diagonal k = x - y
+    backward = {1: 0}  # Same, but walking back from the end.  Diagonal k here is diagonal delta - k going forward
+
+    for d in range((n + m + 1) // 2 + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            if x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                run_length = _common_run_length(a, a_lo + x, b, b_lo + y, min(n - x, m - y))
+                x += run_length
+                y += run_length
+            forward[k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[delta - k] >= n:
+                return 2 * d - 1, x_start, y_start, x, y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            x_start, y_start = x, y
+            if x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                run_length = _common_run_length(a, a_hi - 1 - x, b, b_hi - 1 - y, min(n - x, m - y), step=-1)
+                x += run_length
+                y += run_length
+            backward[k] = x
+            if not odd and -d <= delta - k <= d and x + forward[delta - k] >= n:
+                return 2 * d, n - x, m - y, n - x_start, m - y_start
+
+    # We should never get here.  The searches always meet by D = n + m
+    raise ValueError(f"Failed to find the middle snake of a {n} x {m} edit graph!")
+
+def _matching_runs(a: list, a_lo: int, a_hi: int, b: list, b_lo: int, b_hi: int, runs: list):
+    """
+    Appends the runs of rows that a[a_lo:a_hi] and b[b_lo:b_hi] have in common to runs, in order, as
+    (a_index, b_index, length) tuples
+    """
+
+    # Common prefixes and suffixes are part of every optimal alignment, and skipping them is cheap
+    prefix_length = _common_run_length(a, a_lo, b, b_lo, min(a_hi - a_lo, b_hi - b_lo))
+    if prefix_length:
+        runs.append((a_lo, b_lo, prefix_length))
+        a_lo += prefix_length
+        b_lo += prefix_length
+
+    suffix_length = _common_run_length(a, a_hi - 1, b, b_hi - 1, min(a_hi - a_lo, b_hi - b_lo), step=-1)
+    a_hi -= suffix_length
+    b_hi -= suffix_length
+
+    if a_lo < a_hi and b_lo < b_hi:
+        d, x, y, u, v = _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi)
+        if d > 1:
+            _matching_runs(a, a_lo, a_lo + x, b, b_lo, b_lo + y, runs)
+            if u > x:
+                runs.append((a_lo + x, b_lo + y, u - x))
+            _matching_runs(a, a_lo + u, a_hi, b, b_lo + v, b_hi, runs)
+        elif d == 1:
+            # A single inserted or deleted row.  Everything before and after it matches
+            i = 0
+            while i < min(a_hi - a_lo, b_hi - b_lo) and a[a_lo + i] == b[b_lo + i]:
+                i += 1
+            if i:
+                runs.append((a_lo, b_lo, i))
+            skip_a, skip_b = (1, 0) if a_hi - a_lo > b_hi - b_lo else (0, 1)
+            if a_hi - a_lo - i - skip_a > 0:
+                runs.append((a_lo + i + skip_a, b_lo + i + skip_b, a_hi - a_lo - i - skip_a))
+
+    if suffix_length:
+        runs.append((a_hi, b_hi, suffix_length))
+
+def align_rows(hashes_a: list, hashes_b: list) -> list:
+    """
+    Aligns two sequences of row hashes
+    :return: list of (a_index, b_index, length) runs of matching rows, in order.  Rows outside the runs were
+        inserted or deleted
+    """
+
+    # A row whose hash never occurs in the other file can't be part of any match.  Like GNU diff, drop those rows
+    # before aligning.  The alignment is still optimal, but changed rows no longer count towards D
+    hash_set_a = set(hashes_a)
+    hash_set_b = set(hashes_b)
+    kept_a = list(compress(range(len(hashes_a)), map(hash_set_b.__contains__, hashes_a)))
+    kept_b = list(compress(range(len(hashes_b)), map(hash_set_a.__contains__, hashes_b)))
+    reduced_a = [hashes_a[i] for i in kept_a]
+    reduced_b = [hashes_b[i] for i in kept_b]
+    reduced_runs = []
+    _matching_runs(reduced_a, 0, len(reduced_a), reduced_b, 0, len(reduced_b), reduced_runs)
+
+    # Map the runs back to the original rows, splitting them wherever a dropped row sat in between
+    gaps_a = [p for p in range(1, len(kept_a)) if kept_a[p] != kept_a[p - 1] + 1]
+    gaps_b = [p for p in range(1, len(kept_b)) if kept_b[p] != kept_b[p - 1] + 1]
+    ret_val = []
+    for x, y, length in reduced_runs:
+        split_offsets = set(p - x for p in gaps_a[bisect_right(gaps_a, x):bisect_left(gaps_a, x + length)])
+        split_offsets.update(p - y for p in gaps_b[bisect_right(gaps_b, y):bisect_left(gaps_b, y + length)])
+        start = 0
+        for offset in sorted(split_offsets) + [length]:
+            ret_val.append((kept_a[x + start], kept_b[y + start], offset - start))
+            start = offset
+    return ret_val
+
+def positional_diff(file_a: str, file_b: str, delimiter: str = None, unimportant_fields: list = None,
+                    output_json: bool = False, verbose: bool = False, return_summary: bool = False,
+                    tokenizer: str = 'auto'):
+    """
+    Diffs two delimited files by row position rather than by composite key
+    :param file_a: The first delimited file to compare
+    :param file_b: The second delimited file to compare
+    :param delimiter: The delimiter to use.  If not passed, will be inferred
+    :param unimportant_fields: A list of fields to ignore when comparing rows
+    :param output_json: If True, will print the results as a JSON string to stderr
+    :param verbose: If True, will log verbose output
+    :param return_summary: If True, returns a dict with the keys 'diffs' and 'summary' instead of just the diffs
+    :param tokenizer: How the files are split into fields.  See tokenizer.TOKENIZERS
+    :return: dict of diffs, keyed on row numbers
+    """
+
+    delimiter, column_names_a, column_names_b = read_headers(file_a, file_b, delimiter)
+    matched_fields, unmatched_fields = match_column_names(column_names_a, column_names_b)
+    if verbose is True:
+        logger.info(f"Matched fields: {matched_fields}")
+        logger.info(f"Unmatched fields (not compared in keyless mode): {unmatched_fields}")
+
+    if unimportant_fields is None:
+        unimportant_fields = []
+    elif type(unimportant_fields) is not list:
+        unimportant_fields = [unimportant_fields]
+    for field in unimportant_fields:
+        if field not in matched_fields:
+            raise ValueError(f"Unimportant field [{field}] was is not a field in both files.  "
+                             f"Please check spelling and try again!")
+    compared_fields = [field for field in matched_fields if field not in unimportant_fields]
+
+    """
+    Reduce every row to a hash of its compared fields
+    """
+    rows = {}
+    hashes = {}
+    for side, file in [('A', file_a), ('B', file_b)]:
+        logger.info(f"Reading and hashing File {side} [{file}]...")
+        side_rows = read_rows(file, delimiter, tokenizer)
+        header = side_rows[0]
+        indexes = [header.index(field) for field in compared_fields]
+        width = max(indexes) + 1 if indexes else 0
+        if len(indexes) > 1:
+            project = itemgetter(*indexes)
+        else:
+            project = lambda row: tuple(row[i] for i in indexes)  # itemgetter doesn't return a tuple for one index
+        compared_rows = []
+        for row in side_rows[1:]:
+            if len(row) < width:
+                row = row + [None] * (width - len(row))  # Same as csv.DictReader's restval
+            compared_rows.append(project(row))
+        rows[side] = compared_rows
+        hashes[side] = [hash(row) for row in compared_rows]
+
+    logger.info(f"Aligning {len(hashes['A'])} rows from File A with {len(hashes['B'])} rows from File B...")
+    runs = align_rows(hashes['A'], hashes['B'])
+
+    """
+    Walk the gaps between the matching runs.  Each gap is a hunk of deleted and inserted rows
+    """
+    diffs = {}
+    counters = new_counters()
+    counters['lines_in_file_a'] = len(rows['A'])
+    counters['lines_in_file_b'] = len(rows['B'])
+
+    def _row_number(index: int) -> int:
+        return index + 2  # First data row in a file will be on row 2
+
+    def _one_sided_record(side: str, index: int) -> dict:
+        other_side = 'B' if side == 'A' else 'A'
+        record = {f"_record_present_in_{side}_not_in_{other_side}": True,
+                  f"__row_number_{side}": _row_number(index)}
+        for field, value in zip(compared_fields, rows[side][index]):
+            record[f"{field}_{side}"] = value
+            record[f"{field}_{other_side}"] = None
+            record[f"{field}_LEVENSHTEIN_DISTANCE"] = len(str(value))
+        return record
+
+    a_index = 0
+    b_index = 0
+    for run_a, run_b, run_length in runs + [(len(rows['A']), len(rows['B']), 0)]:
+        deleted = list(range(a_index, run_a))
+        inserted = list(range(b_index, run_b))
+
+        # Pair up deleted and inserted rows at the same spot as changed rows
+        for i in range(min(len(deleted), len(inserted))):
+            row_a = rows['A'][deleted[i]]
+            row_b = rows['B'][inserted[i]]
+            record = {'__row_number_A': _row_number(deleted[i]),
+                      '__row_number_B': _row_number(inserted[i]),
+                      '__field_differences_count': 0}
+            for field, value_a, value_b in zip(compared_fields, row_a, row_b):
+                if value_a != value_b:
+                    record[field] = {'__diff_type': 'Field Difference',
+                                     'A': value_a,
+                                     'B': value_b,
+                                     '__levenshtein_distance': levenshtein_distance(str(value_a), str(value_b))}
+                    record['__field_differences_count'] += 1
+            diffs[f"A{_row_number(deleted[i])}:B{_row_number(inserted[i])}"] = record
+            counters['field_level_diffs'] += record['__field_differences_count']
+            counters['matched_composite_keys'] += 1
+
+        for index in deleted[len(inserted):]:
+            diffs[f"A{_row_number(index)}"] = _one_sided_record('A', index)
+            counters['present_in_a_not_in_b'] += 1
+        for index in inserted[len(deleted):]:
+            diffs[f"B{_row_number(index)}"] = _one_sided_record('B', index)
+            counters['present_in_b_not_in_a'] += 1
+
+        counters['matched_composite_keys'] += run_length
+        a_index = run_a + run_length
+        b_index = run_b + run_length
+
+    counters['total_lines_with_diffs'] = len(diffs)
+
+    print("\n\n[Summary (Keyless)]:")
+    if len(unimportant_fields) > 0:
+        print(f"--> SKIPPED over these unimportant fields: {unimportant_fields}")
+    print(f"Lines in File A: {counters['lines_in_file_a']}")
+    print(f"Lines in File B: {counters['lines_in_file_b']}")
+    print(f"Total lines with diffs (Excluding Unimportant Fields): {counters['total_lines_with_diffs']}")
+    print(f"Total field level diffs (Excluding Unimportant Fields): {counters['field_level_diffs']}")
+    print(f"Total rows deleted (present in A but not in B): {counters['present_in_a_not_in_b']}")
+    print(f"Total rows inserted (present in B but not in A): {counters['present_in_b_not_in_a']}")
+    print(f"Total rows aligned between A and B: {counters['matched_composite_keys']}")
+
+    ret_val = diffs
+
+    if output_json is True:
+        print("\n\n[BEGIN Diff Results as JSON]:", file=sys.stderr)
+        print(json.dumps(ret_val, indent=4), file=sys.stderr)
+        print("\n\n[END Diff Results as JSON]:", file=sys.stderr)
+
+    if return_summary is True:
+        ret_val = dict(diffs=ret_val, summary=counters)
+
+    return ret_val
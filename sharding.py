@@ -0,0 +1,313 @@
+"""
+Splits a diff across multiple processes or machines.
+
+The composite key hash is uniformly distributed, so the key space can be cut into contiguous ranges ("shards") that
+are diffed independently.  The workflow is:
+
+    shard       Stream File A and File B into N pairs of shard files
+    diff-shard  Diff one pair of shard files and write its partial result and summary counters
+    merge       Combine the partial results into the final summary and diff output
+
+Each diff-shard invocation only needs the shard directory, so they can be scheduled on separate machines by any
+batch scheduler (or just run as local processes).
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+from helpers import read_headers
+from helpers import make_composite_key
+from helpers import match_column_names
+from helpers import resolve_composite_key_fields
+from delim_diff import delim_diff
+from delim_diff import _print_summary
+from comparison_result import merge_counters
+from comparison_result import trim_diffs
+from comparison_result import MAX_DIFFS_ORDERS
+
+MANIFEST_FILE_NAME = 'shard_manifest.json'
+KEY_SPACE_PREFIX_WIDTH = 3  # Matches the bucket width used by delim_diff.  Shards are contiguous runs of buckets
+KEY_SPACE_SIZE = 16 ** KEY_SPACE_PREFIX_WIDTH
+
+
+def _shard_index_for_hash(composite_key_hash: str, shard_count: int) -> int:
+    """
+    Maps a composite key hash onto a shard.  Shards own contiguous ranges of the key space
+    :param composite_key_hash: The sha-256 hex digest of the composite key string
+    :param shard_count: The total number of shards
+    :return: The index of the shard that owns this hash
+    """
+    prefix = int(composite_key_hash[:KEY_SPACE_PREFIX_WIDTH], 16)
+    ret_val = prefix * shard_count // KEY_SPACE_SIZE
+    return ret_val
+
+def _shard_file_name(shard_index: int, side: str) -> str:
+    """
+    The file name of one side (A or B) of a shard
+    """
+    ret_val = f"shard_{shard_index:04d}_{side}.txt"
+    return ret_val
+
+def _result_file_name(shard_index: int) -> str:
+    """
+    The file name of the partial result written by diff-shard
+    """
+    ret_val = f"result_{shard_index:04d}.json"
+    return ret_val
+
+def _load_manifest(shard_dir: str) -> dict:
+    """
+    Loads the manifest written by shard_files()
+    """
+    manifest_path = os.path.join(shard_dir, MANIFEST_FILE_NAME)
+    if not os.path.isfile(manifest_path):
+        raise ValueError(f"No shard manifest found at [{manifest_path}]!  Run the shard subcommand first.")
+
+    with open(manifest_path, 'r') as f:
+        ret_val = json.load(f)
+    return ret_val
+
+def shard_files(file_a: str, file_b: str, shard_dir: str, shard_count: int, delimiter: str = None,
+                composite_key_fields: list = None) -> dict:
+    """
+    Streams both files into shard_count pairs of shard files, routing each row by its composite key hash.
+    Neither file is loaded into memory.
+    :param file_a: The first delimited file to compare
+    :param file_b: The second delimited file to compare
+    :param shard_dir: The directory to write the shard files and manifest to.  It is created if needed
+    :param shard_count: The number of shards.  Must be between 1 and 4096
+    :param delimiter: The delimiter to use.  If not passed, will be inferred
+    :param composite_key_fields: A list of fields to use as the composite key.  If not passed, the first matched field
+    :return: The manifest, which is also written to the shard directory
+    """
+
+    if not 1 <= shard_count <= KEY_SPACE_SIZE:
+        raise ValueError(f"Shard count [{shard_count}] must be between 1 and {KEY_SPACE_SIZE}!")
+
+    # Only the headers are needed to work out the delimiter and the composite key
+    delimiter, column_names_a, column_names_b = read_headers(file_a, file_b, delimiter)
+    column_names = {'A': column_names_a, 'B': column_names_b}
+    matched_fields, unmatched_fields = match_column_names(column_names_a, column_names_b)
+
+    composite_key_fields = resolve_composite_key_fields(composite_key_fields, matched_fields)
+
+    os.makedirs(shard_dir, exist_ok=True)
+
+    """
+    Stream the rows into the shard files
+    """
+    row_counts = {'A': [0] * shard_count, 'B': [0] * shard_count}
+    for side, file in [('A', file_a), ('B', file_b)]:
+        print(f"Sharding File {side} [{file}] into {shard_count} shards...")
+        out_handles = [open(os.path.join(shard_dir, _shard_file_name(i, side)), 'w', newline='')
+                       for i in range(shard_count)]
+        try:
+            writers = [csv.writer(h, delimiter=delimiter, lineterminator='\n') for h in out_handles]
+            # The original row number is carried along so that reports from the shards point at the real row.
+            # It goes first so that short or long rows keep the same shape they had in the original file
+            for writer in writers:
+                writer.writerow(['__row_number'] + column_names[side])
+
+            with open(file, 'r', newline='') as f:
+                reader = csv.reader(f, delimiter=delimiter)
+                header = next(reader)
+                key_indexes = [header.index(field) for field in composite_key_fields]
+                row_number = 2  # First data row in a file will be on row 2
+                for row in reader:
+                    if not row:
+                        continue  # csv.DictReader skips blank rows too
+                    key_values = {field: row[i] if i < len(row) else None
+                                  for field, i in zip(composite_key_fields, key_indexes)}
+                    _, composite_key_hash = make_composite_key(key_values, composite_key_fields)
+                    shard_index = _shard_index_for_hash(composite_key_hash, shard_count)
+                    writers[shard_index].writerow([row_number] + row)
+                    row_counts[side][shard_index] += 1
+                    row_number += 1
+        finally:
+            for h in out_handles:
+                h.close()
+
+    manifest = dict(file_a=os.path.abspath(file_a),
+                    file_b=os.path.abspath(file_b),
+                    delimiter=delimiter,
+                    composite_key_fields=composite_key_fields,
+                    shard_count=shard_count,
+                    row_counts=row_counts)
+    with open(os.path.join(shard_dir, MANIFEST_FILE_NAME), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+    print(f"Wrote {shard_count} shard pairs to [{shard_dir}]")
+    return manifest
+
+def diff_shard(shard_dir: str, shard_index: int, unimportant_fields: list = None, verbose: bool = False,
+               use_multiprocessing: bool = True, max_diffs: int = None, max_diffs_order: str = 'hash') -> dict:
+    """
+    Diffs a single pair of shard files and writes the partial result (diffs plus summary counters) to the shard dir
+    :param shard_dir: The directory written by shard_files()
+    :param shard_index: The shard to diff
+    :param unimportant_fields: A list of fields to ignore when comparing rows
+    :param verbose: If True, will print verbose output
+    :param use_multiprocessing: If True, the shard itself is diffed with a pool of worker processes
+    :param max_diffs: If passed, only this many diff records are kept for the shard.  The counters are still exact
+    :param max_diffs_order: Which records are kept when max_diffs is passed.  See delim_diff()
+    :return: The partial result, which is also written to the shard directory
+    """
+
+    manifest = _load_manifest(shard_dir)
+    shard_count = manifest['shard_count']
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard index [{shard_index}] is out of range!  There are {shard_count} shards.")
+
+    print(f"Diffing shard {shard_index} of {shard_count}...")
+    result = delim_diff(file_a=os.path.join(shard_dir, _shard_file_name(shard_index, 'A')),
+                        file_b=os.path.join(shard_dir, _shard_file_name(shard_index, 'B')),
+                        delimiter=manifest['delimiter'],
+                        composite_key_fields=manifest['composite_key_fields'],
+                        unimportant_fields=unimportant_fields,
+                        verbose=verbose,
+                        use_multiprocessing=use_multiprocessing,
+                        return_summary=True,
+                        max_diffs=max_diffs,
+                        max_diffs_order=max_diffs_order,
+                        row_numbers_from_field=True)
+    result['shard_index'] = shard_index
+    result['options'] = dict(unimportant_fields=unimportant_fields or [],
+                             max_diffs=max_diffs,
+                             max_diffs_order=max_diffs_order)
+
+    # Write to a temp file first so that merge never sees a half written result
+    result_path = os.path.join(shard_dir, _result_file_name(shard_index))
+    with open(result_path + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.replace(result_path + '.tmp', result_path)
+
+    print(f"Wrote partial result for shard {shard_index} to [{result_path}]")
+    return result
+
+def merge_shard_results(shard_dir: str, output_json: bool = False) -> dict:
+    """
+    Combines the partial results of every shard into the final summary and diffs.  All shards must have been diffed.
+    :param shard_dir: The directory written by shard_files() and diff_shard()
+    :param output_json: If True, will print the merged diffs as a JSON string to stderr
+    :return: dict of the merged diffs, keyed on composite key hash
+    """
+
+    manifest = _load_manifest(shard_dir)
+    shard_count = manifest['shard_count']
+
+    missing_shards = [i for i in range(shard_count)
+                      if not os.path.isfile(os.path.join(shard_dir, _result_file_name(i)))]
+    if missing_shards:
+        raise ValueError(f"{len(missing_shards)} of {shard_count} shards have no result yet: {missing_shards}.  "
+                         f"Run diff-shard for them before merging.")
+
+    merged_diffs = {}
+    merged_summary = {}
+    options = None
+    for i in range(shard_count):
+        with open(os.path.join(shard_dir, _result_file_name(i)), 'r') as f:
+            result = json.load(f)
+
+        # Shards that were diffed with different options can't be meaningfully combined
+        if options is None:
+            options = result['options']
+        elif result['options'] != options:
+            raise ValueError(f"Shard {i} was diffed with options {result['options']} but "
+                             f"earlier shards used {options}!")
+
+        # Shards own disjoint key ranges, so the diffs never collide and the counters simply add up
+        merged_diffs.update(result['diffs'])
+        merge_counters(merged_summary, result['summary'])
+
+        # Each shard brings at most max_diffs records.  Trim as we go so the total stays bounded
+        max_diffs = options['max_diffs']
+        if max_diffs is not None and len(merged_diffs) > 2 * max_diffs:
+            merged_diffs = trim_diffs(merged_diffs, max_diffs, options['max_diffs_order'])
+
+    if options['max_diffs'] is not None:
+        merged_diffs = trim_diffs(merged_diffs, options['max_diffs'], options['max_diffs_order'])
+
+    print(f"\n\n[Merged {shard_count} shards]:")
+    _print_summary(merged_summary, options['unimportant_fields'])
+    if options['max_diffs'] is not None:
+        print(f"--> Retained {len(merged_diffs)} of {merged_summary['total_lines_with_diffs']} lines with diffs "
+              f"(max diffs = {options['max_diffs']}, by {options['max_diffs_order']})")
+
+    if output_json is True:
+        print("\n\n[BEGIN Diff Results as JSON]:", file=sys.stderr)
+        print(json.dumps(merged_diffs, indent=4), file=sys.stderr)
+        print("\n\n[END Diff Results as JSON]:", file=sys.stderr)
+
+    return merged_diffs
+
+def main(argv: list):
+    """
+    Command line entry point for the shard, diff-shard and merge subcommands
+    :param argv: The command line arguments, starting with the subcommand
+    """
+
+    parser = argparse.ArgumentParser(prog='delim_diff.py',
+                                     description='Split a diff of two delimited files across multiple nodes.')
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+
+    shard_parser = subparsers.add_parser('shard', help='Stream both files into N key-range shard files.')
+    shard_parser.add_argument('--file-a', '-a', type=str, required=True,
+                              help='The first file (File A) to be used in the comparison.')
+    shard_parser.add_argument('--file-b', '-b', type=str, required=True,
+                              help='The second file (File B) to be used in the comparison.')
+    shard_parser.add_argument('--shard-dir', '-o', type=str, required=True,
+                              help='The directory to write the shard files to.')
+    shard_parser.add_argument('--shard-count', '-n', type=int, required=True,
+                              help='The number of shards to split the key space into.')
+    shard_parser.add_argument('--delimiter', '-d', type=str, required=False, default='\t',
+                              help='The delimiter to use when parsing the files.  Default is tab.')
+    shard_parser.add_argument('--composite-key-fields', '-k', type=str, required=False, nargs='+',
+                              help='The field(s) to use as the composite key.  '
+                                   'If not specified, the first matched field will be used.')
+
+    diff_shard_parser = subparsers.add_parser('diff-shard', help='Diff one shard pair and write its partial result.')
+    diff_shard_parser.add_argument('--shard-dir', '-o', type=str, required=True,
+                                   help='The directory written by the shard subcommand.')
+    diff_shard_parser.add_argument('--shard-index', '-i', type=int, required=True,
+                                   help='The (zero based) index of the shard to diff.')
+    diff_shard_parser.add_argument('--unimportant-fields', '-u', type=str, required=False, nargs='+',
+                                   help='The field(s) to ignore when comparing the files.')
+    diff_shard_parser.add_argument('--verbose', '-v', action='store_true', required=False,
+                                   help='Prints out the details of the comparison.')
+    diff_shard_parser.add_argument('--max-diffs', '-m', type=int, required=False,
+                                   help='Keep only this many detailed diff records.  The summary counts are still '
+                                        'exact.')
+    diff_shard_parser.add_argument('--max-diffs-order', type=str, required=False, default='hash',
+                                   choices=MAX_DIFFS_ORDERS,
+                                   help='Which diff records to keep with --max-diffs.  Default is hash.')
+    diff_shard_parser.add_argument('--single-process', '-s', action='store_true', required=False,
+                                   help='Diffs the shard in a single process.')
+
+    merge_parser = subparsers.add_parser('merge', help='Combine the partial results into the final output.')
+    merge_parser.add_argument('--shard-dir', '-o', type=str, required=True,
+                              help='The directory written by the shard and diff-shard subcommands.')
+    merge_parser.add_argument('--output-json', '-j', action='store_true', required=False,
+                              help='If enabled, the merged results of the diff will be output to stderr as JSON.')
+
+    args = parser.parse_args(argv)
+
+    if args.subcommand == 'shard':
+        shard_files(file_a=args.file_a,
+                    file_b=args.file_b,
+                    shard_dir=args.shard_dir,
+                    shard_count=args.shard_count,
+                    delimiter=args.delimiter,
+                    composite_key_fields=args.composite_key_fields)
+    elif args.subcommand == 'diff-shard':
+        diff_shard(shard_dir=args.shard_dir,
+                   shard_index=args.shard_index,
+                   unimportant_fields=args.unimportant_fields,
+                   verbose=args.verbose,
+                   use_multiprocessing=not args.single_process,
+                   max_diffs=args.max_diffs,
+                   max_diffs_order=args.max_diffs_order)
+    elif args.subcommand == 'merge':
+        merge_shard_results(shard_dir=args.shard_dir,
+                            output_json=args.output_json)
@@ -0,0 +1,117 @@
+"""
+Fixed size probabilistic data structures used by the approximate summary mode.  See approximate_summary.py
+
+Both structures are fed integer hashes rather than values, since the callers already have a sha-256 of every key.
+"""
+
+import math
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct hashes seen, using 2^precision one byte registers
+    """
+
+    def __init__(self, precision: int = 14):
+        """
+        :param precision: The number of hash bits used to pick a register.  Between 4 and 18
+        """
+        if not 4 <= precision <= 18:
+            raise ValueError(f"HyperLogLog precision [{precision}] must be between 4 and 18!")
+
+        self.precision = precision
+        self.register_count = 1 << precision
+        self.registers = bytearray(self.register_count)
+        self._remaining_bits = 64 - precision
+        self._remaining_mask = (1 << self._remaining_bits) - 1
+
+    def add_hash(self, hash_value: int):
+        """
+        Adds a uniformly distributed 64 bit hash
+        """
+        register_index = hash_value >> self._remaining_bits
+        remaining = hash_value & self._remaining_mask
+        rank = self._remaining_bits - remaining.bit_length() + 1  # Position of the leftmost 1 bit
+        if rank > self.registers[register_index]:
+            self.registers[register_index] = rank
+
+    def estimate(self) -> float:
+        """
+        The estimated number of distinct hashes added so far
+        """
+        m = self.register_count
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw_estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+
+        # Small range correction.  Linear counting is more accurate while many registers are still empty
+        empty_registers = self.registers.count(0)
+        if raw_estimate <= 2.5 * m and empty_registers > 0:
+            ret_val = m * math.log(m / empty_registers)
+        else:
+            ret_val = raw_estimate
+        return ret_val
+
+    @property
+    def relative_standard_error(self) -> float:
+        return 1.04 / math.sqrt(self.register_count)
+
+    @property
+    def size_in_bytes(self) -> int:
+        return len(self.registers)
+
+
+class BloomFilter:
+    """
+    Tests set membership with no false negatives and a bounded rate of false positives
+    """
+
+    def __init__(self, size_in_bytes: int, expected_items: int):
+        """
+        :param size_in_bytes: The size of the bit array
+        :param expected_items: Roughly how many items will be added.  Used to pick the number of hash functions
+        """
+        if size_in_bytes < 1:
+            raise ValueError(f"Bloom filter size [{size_in_bytes}] must be at least 1 byte!")
+
+        self.bits = bytearray(size_in_bytes)
+        self.bit_count = size_in_bytes * 8
+        expected_items = max(expected_items, 1)
+        self.hash_count = max(1, min(16, round(self.bit_count / expected_items * math.log(2))))
+        self.items_added = 0
+
+    def _bit_indexes(self, hash_value: int):
+        """
+        Derives hash_count bit positions from a single 128 bit hash (Kirsch-Mitzenmacher double hashing)
+        """
+        h1 = hash_value & 0xFFFFFFFFFFFFFFFF
+        h2 = (hash_value >> 64) | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add_hash(self, hash_value: int):
+        """
+        Adds a uniformly distributed 128 bit hash
+        """
+        for bit_index in self._bit_indexes(hash_value):
+            self.bits[bit_index >> 3] |= 1 << (bit_index & 7)
+        self.items_added += 1
+
+    def contains_hash(self, hash_value: int) -> bool:
+        """
+        False if the hash was definitely never added.  True if it probably was
+        """
+        for bit_index in self._bit_indexes(hash_value):
+            if not self.bits[bit_index >> 3] & (1 << (bit_index & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self) -> float:
+        """
+        The expected false positive rate, given how many items have been added
+        """
+        ret_val = (1 - math.exp(-self.hash_count * self.items_added / self.bit_count)) ** self.hash_count
+        return ret_val
+
+    @property
+    def size_in_bytes(self) -> int:
+        return len(self.bits)
@@ -0,0 +1,248 @@
+"""
+Reads delimited files into rows or records, with a fast path for files that contain no quoting.
+
+csv.DictReader handles every corner of the format, but most of our exports (TSV in particular) never contain a quote
+character, and for those a row is simply a line split on the delimiter.  The fast path reads the file as bytes, cuts
+it into batches of whole lines, and scans each batch for a quote (a C level bytes search) before splitting it with
+str.split.  As soon as a batch contains a quote, or a bare carriage return, the rest of the file is handed to the
+csv module, so the output is always the same as csv.DictReader's:
+
+    - Blank lines are skipped
+    - Missing trailing fields are None
+    - Extra trailing fields are collected in a list under the None key
+
+In binary mode (binary=True) the rows are left as bytes: lines are split with bytes.split, and nothing is decoded.
+The csv fallback decodes as latin-1, which maps every byte to one character and back, so even files with mixed
+encodings survive it unchanged.
+
+Tokenizers:
+
+    auto  Scan a sample from the start of the file.  Use the fast path if it has no quotes, else the csv module
+    fast  Skip the sample scan and start on the fast path.  Still falls back to the csv module on the first quote
+    csv   Always use the csv module
+"""
+
+import gc
+import io
+import os
+import csv
+import locale
+import logging
+from contextlib import contextmanager
+from helpers import detect_quoting
+
+logger = logging.getLogger(__name__)
+
+TOKENIZERS = ['auto', 'fast', 'csv']
+SAMPLE_SIZE_BYTES = 1 << 16  # How much of a file the auto tokenizer scans for quotes
+BATCH_SIZE_BYTES = 1 << 22  # How much of a file the fast path decodes and splits at a time
+QUOTE_CHAR = '"'
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Pauses the cyclic garbage collector.  Reading a file allocates millions of lists and dicts, which can't form
+    reference cycles, but each allocation still counts towards the next collection, and every collection scans all of
+    the rows read so far.  Left running, the collector takes most of the time spent reading a large file
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def _csv_rows(text: str, delimiter: str) -> list:
+    """
+    Splits text into rows with the csv module, skipping blank lines
+    """
+
+    # Same newline handling as opening the file in text mode
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    ret_val = [row for row in csv.reader(io.StringIO(text), delimiter=delimiter) if row]
+    return ret_val
+
+def read_sample(file_name: str, encoding: str = None) -> str:
+    """
+    Reads the start of a file.  Enough for the header, delimiter inference and quote detection
+    :param file_name: The file to read
+    :param encoding: If passed, the sample is read as bytes and decoded with this encoding, replacing anything that
+        doesn't decode.  Otherwise the file is read in text mode
+    """
+    if not os.path.isfile(file_name):
+        raise ValueError(f"{file_name} is not an actual file!")
+    if encoding is not None:
+        with open(file_name, 'rb') as f:
+            sample = f.read(SAMPLE_SIZE_BYTES)
+            if b'\n' not in sample:
+                sample += f.readline()  # Make sure that the whole header is in the sample
+        ret_val = sample.decode(encoding, errors='replace').replace('\r\n', '\n')
+        return ret_val
+
+    with open(file_name, 'r') as f:
+        ret_val = f.read(SAMPLE_SIZE_BYTES)
+        if '\n' not in ret_val:
+            ret_val += f.readline()  # Make sure that the whole header is in the sample
+    return ret_val
+
+def read_rows(file_name: str, delimiter: str, tokenizer: str = 'auto', binary: bool = False,
+              encoding: str = None) -> list:
+    """
+    Reads a delimited file into a list of rows (lists of strings, or of bytes in binary mode), header included
+    :param file_name: The delimited file to read
+    :param delimiter: The delimiter to split on
+    :param tokenizer: One of TOKENIZERS.  See the module docstring
+    :param binary: If True, the fields are returned as bytes and never decoded
+    :param encoding: The encoding of the file.  Defaults to the platform default, as when opening the file in text
+        mode.  In binary mode it is only used to encode the delimiter
+    :return: list of rows.  Blank lines are skipped
+    """
+    if tokenizer not in TOKENIZERS:
+        raise ValueError(f"Tokenizer [{tokenizer}] must be one of {TOKENIZERS}!")
+    if not os.path.isfile(file_name):
+        raise ValueError(f"{file_name} is not an actual file!")
+
+    encoding = encoding or locale.getpreferredencoding(False)
+    with open(file_name, 'rb') as f:
+        data = f.read()
+
+    if tokenizer == 'auto':
+        sample = data[:SAMPLE_SIZE_BYTES].decode(encoding, errors='ignore')
+        tokenizer = 'csv' if detect_quoting(sample, QUOTE_CHAR) else 'fast'
+    logger.info(f"Reading [{file_name}] with the {tokenizer} tokenizer{' in binary mode' if binary else ''}")
+
+    with _gc_paused():
+        if tokenizer == 'csv':
+            ret_val = _fallback_rows(data, delimiter, encoding, binary)
+        else:
+            ret_val = _fast_rows(file_name, data, delimiter, encoding, binary)
+    return ret_val
+
+def _fallback_rows(data: bytes, delimiter: str, encoding: str, binary: bool) -> list:
+    """
+    Splits data into rows with the csv module.  In binary mode, the data goes through the csv module as latin-1,
+    which round trips every byte
+    """
+    if binary is True:
+        ret_val = [[field.encode('latin-1') for field in row] for row in _csv_rows(data.decode('latin-1'), delimiter)]
+    else:
+        ret_val = _csv_rows(data.decode(encoding), delimiter)
+    return ret_val
+
+def _iter_csv_rows(chunks, delimiter: str, encoding: str, binary: bool):
+    """
+    Splits a stream of chunks of whole lines into rows with the csv module, as the chunks arrive.  The same rows as
+    _fallback_rows() on the chunks joined together, without holding them all in memory
+    """
+    text_encoding = 'latin-1' if binary is True else encoding
+
+    def lines():
+        for chunk in chunks:
+            # Same newline handling as _csv_rows().  A chunk ends on a newline, so no \r\n is split between chunks
+            yield from io.StringIO(chunk.decode(text_encoding).replace('\r\n', '\n').replace('\r', '\n'))
+
+    for row in csv.reader(lines(), delimiter=delimiter):
+        if not row:
+            continue
+        if binary is True:
+            row = [field.encode('latin-1') for field in row]
+        yield row
+
+def _split_batch(batch: bytes, delimiter: str, encoding: str, binary: bool):
+    """
+    Splits a batch of whole lines on the delimiter, without the csv module
+    :return: list of rows, or None if the batch contains a quote or a bare carriage return, and so needs the csv module
+    """
+    if QUOTE_CHAR.encode(encoding) in batch:
+        ret_val = None
+        return ret_val
+
+    if binary is True:
+        text, newline, carriage_return, split_delimiter = batch, b'\n', b'\r', delimiter.encode(encoding)
+    else:
+        text, newline, carriage_return, split_delimiter = batch.decode(encoding), '\n', '\r', delimiter
+    if carriage_return in text:
+        text = text.replace(carriage_return + newline, newline)
+        if carriage_return in text:
+            ret_val = None
+            return ret_val
+
+    ret_val = [line.split(split_delimiter) for line in text.split(newline) if line]
+    return ret_val
+
+def _fast_rows(file_name: str, data: bytes, delimiter: str, encoding: str, binary: bool) -> list:
+    """
+    The fast path of read_rows().  Splits batches of whole lines on the delimiter, and hands the rest of the file to
+    the csv module once a batch contains a quote or a bare carriage return
+    """
+    rows = []
+    position = 0
+    while position < len(data):
+        end = data.find(b'\n', position + BATCH_SIZE_BYTES)
+        end = len(data) if end == -1 else end + 1
+
+        batch_rows = _split_batch(data[position:end], delimiter, encoding, binary)
+        if batch_rows is None:
+            logger.info(f"Found a quote character or a bare carriage return in [{file_name}] after {len(rows)} rows.  "
+                        f"Falling back to the csv module for the rest of the file")
+            rows.extend(_fallback_rows(data[position:], delimiter, encoding, binary))
+            break
+
+        rows.extend(batch_rows)
+        position = end
+
+    ret_val = rows
+    return ret_val
+
+def _decode_header(header: list, encoding: str, binary: bool) -> list:
+    """
+    Decodes the field names of a header read in binary mode.  Field names are always str
+    """
+    ret_val = header
+    if binary is True:
+        ret_val = [field.decode(encoding or locale.getpreferredencoding(False), errors='replace') for field in header]
+    return ret_val
+
+def _rows_to_records(header: list, rows: list) -> list:
+    """
+    Turns rows into dicts keyed on the header, with the same handling of short and long rows as csv.DictReader
+    """
+    width = len(header)
+    with _gc_paused():
+        if all(len(row) == width for row in rows):
+            # The usual case.  Every row has exactly as many fields as the header
+            records = [dict(zip(header, row)) for row in rows]
+        else:
+            records = []
+            for row in rows:
+                record = dict(zip(header, row))
+                if len(row) < width:
+                    for field in header[len(row):]:
+                        record[field] = None
+                elif len(row) > width:
+                    record[None] = row[width:]
+                records.append(record)
+
+    ret_val = records
+    return ret_val
+
+def read_records(file_name: str, delimiter: str, tokenizer: str = 'auto', binary: bool = False,
+                 encoding: str = None) -> list:
+    """
+    Reads a delimited file into a list of dicts keyed on the header, the same as list(csv.DictReader(...))
+    :param file_name: The delimited file to read
+    :param delimiter: The delimiter to split on
+    :param tokenizer: One of TOKENIZERS.  See the module docstring
+    :param binary: If True, the values are bytes.  The field names in the header are still decoded
+    :param encoding: The encoding of the file.  See read_rows()
+    :return: list of dicts
+    """
+    rows = read_rows(file_name, delimiter, tokenizer, binary, encoding)
+    if not rows:
+        ret_val = []
+        return ret_val
+
+    ret_val = _rows_to_records(_decode_header(rows[0], encoding, binary), rows[1:])
+    return ret_val